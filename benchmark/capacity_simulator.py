@@ -0,0 +1,309 @@
+# Simulates the throughput limits of provisioned and on-demand DynamoDb tables on top of the in-memory stand-in, so
+# the importer's concurrency, rate limiting and retries can be tuned offline.
+#
+# Every table has a read and a write token bucket refilled at its provisioned capacity, and so does every partition,
+# capped at the 3000 RCU / 1000 WCU a single partition serves. Capacity is charged by item size like DynamoDb does.
+# Requests that find an empty bucket fail with ProvisionedThroughputExceededException, batch requests hand back
+# the items and keys that didn't fit as UnprocessedItems / UnprocessedKeys. Adaptive capacity isn't simulated.
+#
+#   python benchmark/capacity_simulator.py run --write-capacity 100 --read-capacity 100 --trace-output trace.jsonl
+#   python benchmark/capacity_simulator.py run --write-capacity 100 --set RATE_LIMIT_CAPACITY_PERCENT=90 --set CONCURRENT_SECTIONS=false
+#   python benchmark/capacity_simulator.py replay trace.jsonl --write-capacity 50 --burst-seconds 0
+#
+# 'run' imports a synthetic feed with the importer against the simulated tables and prints a latency / throttle
+# timeline. 'replay' sends the requests of a recorded trace again at the same offsets against other capacity
+# settings, throttled requests of a replay aren't retried.
+
+import argparse
+import hashlib
+import json
+import math
+import tempfile
+import threading
+import time
+
+import fakes
+import generate_feed
+import run_benchmark
+
+
+# Capacity units a single partition serves per second
+PARTITION_READ_UNITS = 3000
+PARTITION_WRITE_UNITS = 1000
+
+# Unused capacity is kept for up to this many seconds as burst capacity. Buckets start without any, a full burst
+# bucket would absorb the first minutes of an import and hide the throttling the import runs into afterwards.
+BURST_SECONDS = 300
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst_seconds, now):
+        self.rate = rate
+        # A bucket always holds at least one second of capacity, it starts with just that and only builds up burst
+        # capacity from what the import leaves unused
+        self.size = rate * max(1, burst_seconds)
+        self.tokens = rate
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.size, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class CapacitySimulator(fakes.FakeDynamoDb):
+    # capacities maps table names to (read capacity units, write capacity units), 0 for an on-demand table.
+    # On-demand tables are only limited per partition.
+
+    def __init__(self, recorder, key_schemas, capacities, partitions = None, burst_seconds = BURST_SECONDS, clock = time.monotonic):
+        super().__init__(recorder, key_schemas)
+        self.capacities = capacities
+        self.partitions = partitions
+        self.burst_seconds = burst_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.enabled = True
+
+        for table_name, table in self.tables.items():
+            table.read_capacity_units, table.write_capacity_units = capacities.get(table_name, (0, 0))
+        self.reset()
+
+    def reset(self):
+        # Fills all of the buckets again and starts a new trace
+        with self.lock:
+            self.started = self.clock()
+            self.events = []
+            self.table_buckets = {}
+            self.partition_buckets = {}
+            self.partition_counts = {}
+
+            for table_name in self.tables:
+                read_units, write_units = self.capacities.get(table_name, (0, 0))
+                partition_count = self.partitions or max(1, math.ceil(read_units / PARTITION_READ_UNITS + write_units / PARTITION_WRITE_UNITS))
+                self.partition_counts[table_name] = partition_count
+
+                for capacity, units, partition_units in (('read', read_units, PARTITION_READ_UNITS), ('write', write_units, PARTITION_WRITE_UNITS)):
+                    if units:
+                        self.table_buckets[(table_name, capacity)] = TokenBucket(units, self.burst_seconds, self.started)
+                    partition_rate = min(units / partition_count, partition_units) if units else partition_units
+                    for partition in range(partition_count):
+                        self.partition_buckets[(table_name, capacity, partition)] = TokenBucket(partition_rate, self.burst_seconds, self.started)
+
+    def consume(self, table_name, capacity, partition_key, units):
+        if not self.enabled:
+            return True
+
+        now = self.clock()
+        with self.lock:
+            buckets = [self.table_buckets.get((table_name, capacity))]
+            if partition_key is not None:
+                partition = get_partition(partition_key, self.partition_counts[table_name])
+                buckets.append(self.partition_buckets[(table_name, capacity, partition)])
+            buckets = [bucket for bucket in buckets if bucket is not None]
+
+            # A request goes through as long as the buckets aren't empty, the buckets can go into debt for it
+            for bucket in buckets:
+                bucket.refill(now)
+            throttled = any(bucket.tokens <= 0 for bucket in buckets)
+            if not throttled:
+                for bucket in buckets:
+                    bucket.tokens -= units
+
+            self.events.append({
+                'offset': round(now - self.started, 6),
+                'table': table_name,
+                'capacity': capacity,
+                'partitionKey': None if partition_key is None else str(partition_key),
+                'units': units,
+                'throttled': throttled
+                })
+        return not throttled
+
+
+def get_partition(partition_key, partition_count):
+    return int(hashlib.md5(str(partition_key).encode('utf-8')).hexdigest(), 16) % partition_count
+
+
+def replay_trace(events, key_schemas, capacities, partitions = None, burst_seconds = BURST_SECONDS):
+    # Sends the requests of a trace again at their recorded offsets on a simulated clock and returns the new trace
+    now = [0]
+    simulator = CapacitySimulator(fakes.CallRecorder(), key_schemas, capacities, partitions, burst_seconds, clock = lambda: now[0])
+    for event in sorted(events, key = lambda event: event['offset']):
+        now[0] = event['offset']
+        simulator.consume(event['table'], event['capacity'], event['partitionKey'], event['units'])
+    return simulator.events
+
+
+def build_timeline(events, interval_seconds = 1, calls = None):
+    # Requests, consumed and throttled capacity per interval, with the latency of the calls of the interval
+    # when the trace of the call recorder is given
+    rows = {}
+    for event in events:
+        row = rows.setdefault(int(event['offset'] // interval_seconds), new_timeline_row())
+        row['requests'] += 1
+        if event['throttled']:
+            row['throttled_' + event['capacity']] += 1
+        else:
+            row[event['capacity'] + '_units'] += event['units']
+
+    latencies = {}
+    for call in calls or []:
+        index = int(call['offset'] // interval_seconds)
+        rows.setdefault(index, new_timeline_row())
+        latencies.setdefault(index, []).append(call['latency'] * 1000)
+
+    timeline = []
+    for index in range(max(rows) + 1 if rows else 0):
+        row = rows.get(index, new_timeline_row())
+        row['start_seconds'] = index * interval_seconds
+        row['calls'] = len(latencies.get(index, []))
+        row['latency_p50_ms'] = percentile(latencies.get(index), 50)
+        row['latency_p99_ms'] = percentile(latencies.get(index), 99)
+        timeline.append(row)
+    return timeline
+
+
+def new_timeline_row():
+    return {'requests': 0, 'read_units': 0, 'write_units': 0, 'throttled_read': 0, 'throttled_write': 0}
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)], 2)
+
+
+def print_timeline(timeline, interval_seconds):
+    print(f"{'Second':>8}  {'Calls':>6}  {'p50 ms':>7}  {'p99 ms':>7}  {'Requests':>8}  {'RCU/s':>8}  {'WCU/s':>8}  {'Thr rd':>6}  {'Thr wr':>6}")
+    for row in timeline:
+        print(f"{row['start_seconds']:>8}  {row['calls']:>6}  {format_value(row['latency_p50_ms']):>7}  {format_value(row['latency_p99_ms']):>7}  "
+              f"{row['requests']:>8}  {row['read_units'] / interval_seconds:>8.1f}  {row['write_units'] / interval_seconds:>8.1f}  "
+              f"{row['throttled_read']:>6}  {row['throttled_write']:>6}")
+
+
+def format_value(value):
+    return '-' if value is None else str(value)
+
+
+def print_throttle_summary(events):
+    totals = {}
+    for event in events:
+        total = totals.setdefault((event['table'], event['capacity']), {'requests': 0, 'throttled': 0, 'units': 0})
+        total['requests'] += 1
+        if event['throttled']:
+            total['throttled'] += 1
+        else:
+            total['units'] += event['units']
+
+    for (table_name, capacity), total in sorted(totals.items()):
+        print(f"{table_name} {capacity}: {total['requests']} requests, {total['throttled']} throttled, {total['units']:.1f} capacity units consumed")
+
+
+def get_capacities(arguments, table_names):
+    capacities = {table_name: (arguments.read_capacity, arguments.write_capacity) for table_name in table_names}
+    for table_capacity in arguments.table_capacity:
+        table_name, units = table_capacity.split('=', 1)
+        read_units, write_units = units.split(':')
+        capacities[table_name] = (float(read_units), float(write_units))
+    return capacities
+
+
+def parse_overrides(settings):
+    # NAME=VALUE pairs, values are read as JSON and taken as a string otherwise
+    overrides = {}
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+
+def run_import(arguments):
+    importer = run_benchmark.load_importer()
+    recorder = fakes.CallRecorder(arguments.latency_ms / 1000, arguments.jitter_ms / 1000, keep_trace = True)
+    simulator = CapacitySimulator(recorder, importer.TABLE_KEYS, get_capacities(arguments, importer.TABLE_KEYS),
+                                  arguments.partitions, arguments.burst_seconds)
+    fake_s3, _ = run_benchmark.install_fakes(importer, recorder, simulator)
+    run_benchmark.configure(importer, {**run_benchmark.MODES[arguments.mode], **parse_overrides(arguments.set)},
+                            tempfile.mkdtemp(prefix = 'import-capacity-'))
+    # The importer's client only retries throttled requests itself when the importer doesn't rate limit them
+    simulator.client_max_attempts = 1 if importer.RATE_LIMIT_REQUESTS else fakes.CLIENT_LEGACY_MAX_ATTEMPTS
+
+    feed = generate_feed.generate_feed(arguments.movies, arguments.tv_shows, arguments.seasons, arguments.episodes, arguments.seed)
+    if arguments.scenario == 'reimport':
+        # The previous feed is loaded without throttling, only the import of the changed feed is simulated
+        simulator.enabled = False
+        fake_s3.put_feed(importer.JSON_FILE, feed)
+        run_benchmark.run_import(importer, {'force': True})
+        feed = generate_feed.change_feed(feed, arguments.changed_percent, arguments.new_percent, arguments.seed + 1)
+        simulator.enabled = True
+    fake_s3.put_feed(importer.JSON_FILE, feed)
+
+    simulator.reset()
+    recorder.started = simulator.started
+    recorder.trace.clear()
+    started = time.perf_counter()
+    result = run_benchmark.run_import(importer, {'force': True})
+    wall_time = time.perf_counter() - started
+
+    records = generate_feed.count_records(feed)
+    print(f"Mode {arguments.mode}: {result['status']}, {records} records in {wall_time:.2f} s, {records / wall_time:.1f} records/s")
+    return simulator.events, recorder.trace
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Simulate DynamoDb throughput limits for the importer')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    run_parser = subparsers.add_parser('run', help = 'import a synthetic feed against the simulated tables')
+    replay_parser = subparsers.add_parser('replay', help = 'replay a recorded trace against other capacity settings')
+    replay_parser.add_argument('trace', help = 'JSON lines trace written by run --trace-output')
+
+    for subparser in (run_parser, replay_parser):
+        subparser.add_argument('--read-capacity', type = float, default = 0, help = 'provisioned RCU of every table, 0 for on-demand')
+        subparser.add_argument('--write-capacity', type = float, default = 0, help = 'provisioned WCU of every table, 0 for on-demand')
+        subparser.add_argument('--table-capacity', action = 'append', default = [], metavar = 'TABLE=READ:WRITE',
+                               help = 'provisioned capacity of a single table')
+        subparser.add_argument('--partitions', type = int, help = 'partitions per table, derived from the capacity by default')
+        subparser.add_argument('--burst-seconds', type = float, default = BURST_SECONDS)
+        subparser.add_argument('--interval', type = float, default = 1, help = 'seconds per timeline row')
+        subparser.add_argument('--json', action = 'store_true', help = 'print the timeline as JSON')
+
+    run_parser.add_argument('--mode', choices = list(run_benchmark.MODES), default = 'default')
+    run_parser.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE',
+                            help = 'override an importer setting, e.g. --set RATE_LIMIT_CAPACITY_PERCENT=80')
+    run_parser.add_argument('--movies', type = int, default = 1000)
+    run_parser.add_argument('--tv-shows', type = int, default = 50)
+    run_parser.add_argument('--seasons', type = int, default = 4)
+    run_parser.add_argument('--episodes', type = int, default = 10)
+    run_parser.add_argument('--seed', type = int, default = 0)
+    run_parser.add_argument('--latency-ms', type = float, default = 5)
+    run_parser.add_argument('--jitter-ms', type = float, default = 5)
+    run_parser.add_argument('--scenario', choices = ['new', 'reimport'], default = 'new')
+    run_parser.add_argument('--changed-percent', type = float, default = 5)
+    run_parser.add_argument('--new-percent', type = float, default = 1)
+    run_parser.add_argument('--trace-output', help = 'write the requests of the import to this JSON lines file')
+    arguments = parser.parse_args()
+
+    if arguments.command == 'run':
+        events, calls = run_import(arguments)
+        if arguments.trace_output:
+            with open(arguments.trace_output, 'w') as file:
+                for event in events:
+                    file.write(json.dumps(event) + '\n')
+    else:
+        with open(arguments.trace) as file:
+            recorded_events = [json.loads(line) for line in file if line.strip()]
+        table_names = sorted({event['table'] for event in recorded_events})
+        key_schemas = {table_name: ('key',) for table_name in table_names}
+        events = replay_trace(recorded_events, key_schemas, get_capacities(arguments, table_names), arguments.partitions, arguments.burst_seconds)
+        calls = None
+
+    timeline = build_timeline(events, arguments.interval, calls)
+    if arguments.json:
+        print(json.dumps(timeline, indent = 2))
+    else:
+        print_throttle_summary(events)
+        print_timeline(timeline, arguments.interval)
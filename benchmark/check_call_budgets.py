@@ -0,0 +1,129 @@
+# Imports synthetic feeds into the in-memory DynamoDb stand-in and fails when an import scenario makes more
+# DynamoDb calls than its budget allows, so a change adding round trips per record is caught before it ships.
+#
+#   python benchmark/check_call_budgets.py
+#   python benchmark/check_call_budgets.py --show-counts
+#
+# Budgets are per operation, as calls per record of the imported feed plus a fixed number of calls per import.
+# Lower a budget when an optimization makes it stale, raise one only when the extra calls are intended.
+
+import argparse
+import sys
+import tempfile
+
+import fakes
+import generate_feed
+import run_benchmark
+
+
+OPERATIONS = ['Query', 'GetItem', 'BatchGetItem', 'PutItem', 'BatchWriteItem', 'UpdateItem', 'Scan']
+
+# Size of the feeds the scenarios import
+FEED_SIZE = {'movies': 300, 'tv_shows': 12, 'seasons': 3, 'episodes': 8}
+
+# Share of the records changed and added in the feed of the reimport scenarios
+CHANGED_PERCENT = 10
+NEW_PERCENT = 5
+
+# Scenarios as (configuration overrides, how the tables start out, whether the import is forced past the unchanged feed check).
+# 'empty' imports into empty tables, 'same feed' over the same feed and 'changed feed' over the previous version of the feed.
+SCENARIOS = {
+    'new-only feed': ({}, 'empty', False),
+    'unchanged feed': ({}, 'same feed', False),
+    'unchanged feed, forced': ({}, 'same feed', True),
+    'changed feed': ({}, 'changed feed', False),
+    'changed feed, update movies': ({'UPDATE_EXISTING_MOVIE_DATA': True}, 'changed feed', False),
+    'changed feed, update tv shows': ({'UPDATE_EXISTING_TV_DATA': True}, 'changed feed', False),
+    'changed feed, update episodes': ({'UPDATE_EXISTING_EPISODE_DATA': True}, 'changed feed', False),
+    'new-only feed, update all': ({**run_benchmark.UPDATE_EXISTING_DATA}, 'empty', False),
+    'changed feed, update all': ({**run_benchmark.UPDATE_EXISTING_DATA}, 'changed feed', False),
+    'changed feed, update all with lookups': ({**run_benchmark.UPDATE_EXISTING_DATA, 'UPSERT_WITH_UPDATE_ITEM': False}, 'changed feed', False),
+    # Every record looked up on its own with the get_dynamo_record_* queries, nothing skipped, prefetched, indexed or cached,
+    # so a second query per record goes over the budget
+    'changed feed, update all with single lookups': ({
+        **run_benchmark.UPDATE_EXISTING_DATA,
+        'SKIP_UNCHANGED_RECORDS': False,
+        'UPSERT_WITH_UPDATE_ITEM': False,
+        'PREFETCH_EXISTING_RECORDS': False,
+        'LOAD_EPISODE_INDEX_PER_SHOW': False,
+        'CACHE_LOOKUPS': False
+        }, 'changed feed', False),
+    # The same feed again on a warm container with neither the feed nor the records skipped by the stored state,
+    # the existing keys remembered by WARM_KEY_CACHE leave nothing to write
+    'unchanged feed, warm key cache': ({'SKIP_UNCHANGED_FEED': False, 'SKIP_UNCHANGED_RECORDS': False}, 'same feed', False)
+}
+
+# Budget of each scenario as operation -> (calls per record, calls per import), operations left out mustn't be called
+BUDGETS = {
+    'new-only feed': {'PutItem': (1, 0)},
+    'unchanged feed': {},
+    'unchanged feed, forced': {'PutItem': (1, 0)},
+    'changed feed': {'PutItem': (0.03, 0)},
+    'changed feed, update movies': {'PutItem': (0.03, 0), 'UpdateItem': (0.08, 0)},
+    'changed feed, update tv shows': {'PutItem': (0.03, 0), 'UpdateItem': (0.01, 0)},
+    'changed feed, update episodes': {'PutItem': (0.03, 0), 'UpdateItem': (0.06, 0)},
+    'new-only feed, update all': {'UpdateItem': (1, 0)},
+    'changed feed, update all': {'UpdateItem': (0.14, 0)},
+    'changed feed, update all with lookups': {'Query': (0.02, 0), 'BatchGetItem': (0.01, 3), 'BatchWriteItem': (0.01, 3)},
+    'changed feed, update all with single lookups': {'Query': (1, 0), 'BatchWriteItem': (0.04, 3)},
+    'unchanged feed, warm key cache': {}
+}
+
+
+def run_scenario(name):
+    # Returns the number of records imported and the DynamoDb calls per operation of the measured import
+    overrides, tables, force = SCENARIOS[name]
+    importer = run_benchmark.load_importer()
+    recorder = fakes.CallRecorder()
+    fake_s3, fake_dynamodb = run_benchmark.install_fakes(importer, recorder)
+    run_benchmark.configure(importer, overrides, tempfile.mkdtemp(prefix = 'import-call-budgets-'))
+
+    feed = generate_feed.generate_feed(FEED_SIZE['movies'], FEED_SIZE['tv_shows'], FEED_SIZE['seasons'], FEED_SIZE['episodes'])
+    if tables != 'empty':
+        fake_s3.put_feed(importer.JSON_FILE, feed)
+        run_benchmark.run_import(importer, {})
+        if tables == 'changed feed':
+            feed = generate_feed.change_feed(feed, CHANGED_PERCENT, NEW_PERCENT)
+            fake_s3.put_feed(importer.JSON_FILE, feed)
+        recorder.calls.clear()
+    else:
+        fake_s3.put_feed(importer.JSON_FILE, feed)
+
+    result = run_benchmark.run_import(importer, {'force': True} if force else {})
+    if result['status'] not in ('completed', 'unchanged'):
+        raise RuntimeError(f"Scenario {name} ended with status {result['status']}")
+
+    calls = {operation: recorder.calls.get('dynamodb.' + operation, 0) for operation in OPERATIONS}
+    return generate_feed.count_records(feed), calls
+
+
+def check_budget(name, records, calls):
+    # Returns a message per operation that went over its budget
+    budget = BUDGETS[name]
+    failures = []
+    for operation in OPERATIONS:
+        per_record, per_import = budget.get(operation, (0, 0))
+        allowed = int(per_record * records + per_import)
+        if calls[operation] > allowed:
+            failures.append(f"{name}: {calls[operation]} {operation} calls for {records} records, the budget is {allowed}")
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Check the DynamoDb calls of each import scenario against its budget')
+    parser.add_argument('--scenarios', nargs = '+', choices = list(SCENARIOS), default = list(SCENARIOS))
+    parser.add_argument('--show-counts', action = 'store_true', help = 'print the calls each scenario made')
+    arguments = parser.parse_args()
+
+    failures = []
+    for name in arguments.scenarios:
+        records, calls = run_scenario(name)
+        scenario_failures = check_budget(name, records, calls)
+        failures += scenario_failures
+        print(f"{'FAIL' if scenario_failures else 'ok':4}  {name}")
+        if arguments.show_counts:
+            print('      ' + ', '.join(f"{operation} {count}" for operation, count in calls.items() if count) + f" for {records} records")
+
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,502 @@
+# In-memory stand-ins for the S3 client and the DynamoDb resource the importer uses, so it can be run and measured
+# without an AWS account. Every call sleeps for the configured latency and is counted per operation.
+
+import collections
+import copy
+import functools
+import hashlib
+import io
+import json
+import math
+import random
+import shutil
+import threading
+import time
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+
+# Items returned per Scan page, DynamoDb stops a page at 1 MB
+SCAN_PAGE_SIZE = 500
+
+
+class CallRecorder:
+    # Counts calls per operation and adds the simulated round trip time to each of them
+
+    def __init__(self, latency_seconds = 0, latency_jitter_seconds = 0, keep_trace = False):
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        # Offset from the start, operation and latency of every call when keep_trace is set
+        self.trace = [] if keep_trace else None
+        self.started = time.monotonic()
+
+    def record(self, operation, count = 1):
+        latency = self.latency_seconds + random.uniform(0, self.latency_jitter_seconds)
+        with self.lock:
+            self.calls[operation] += count
+            if self.trace is not None:
+                self.trace.append({'offset': time.monotonic() - self.started, 'operation': operation, 'latency': latency})
+
+        if latency > 0:
+            time.sleep(latency)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+def client_error(code, operation, message = ''):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+class FakeS3:
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_feed(self, key, feed):
+        self.objects[key] = json.dumps(feed).encode('utf-8')
+
+    def get_object(self, Bucket, Key, IfNoneMatch = None, IfMatch = None, Range = None, **kwargs):
+        self.recorder.record('s3.GetObject')
+        with self.lock:
+            if Key not in self.objects:
+                raise client_error('NoSuchKey', 'GetObject')
+            body = self.objects[Key]
+
+        etag = get_etag(body)
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise client_error('304', 'GetObject', 'Not Modified')
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error('PreconditionFailed', 'GetObject')
+        if Range is not None:
+            # Only the 'bytes=first-last' form the importer asks for
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'ContentLength': len(body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.recorder.record('s3.PutObject')
+        with self.lock:
+            self.objects[Key] = bytes(Body)
+        return {'ETag': get_etag(Body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.recorder.record('s3.DeleteObject')
+        with self.lock:
+            self.objects.pop(Key, None)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.recorder.record('s3.UploadFile')
+        with open(Filename, 'rb') as file:
+            body = file.read()
+        with self.lock:
+            self.objects[Key] = body
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.recorder.record('s3.DownloadFile')
+        with self.lock:
+            if Key not in self.objects:
+                raise client_error('404', 'HeadObject', 'Not Found')
+            body = self.objects[Key]
+        with open(Filename, 'wb') as file:
+            shutil.copyfileobj(io.BytesIO(body), file)
+
+
+def get_etag(body):
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+# Attempts and backoff base of botocore's legacy retry mode for DynamoDb
+CLIENT_LEGACY_MAX_ATTEMPTS = 10
+CLIENT_RETRY_BASE_SECONDS = 0.05
+
+
+def client_call(operation):
+    # Counts a DynamoDb call and retries it while it is throttled, like the boto3 client does before the importer sees the error
+    def decorator(function):
+        @functools.wraps(function)
+        def call(self, *args, **kwargs):
+            dynamodb = getattr(self, 'dynamodb', self)
+            attempt = 1
+            while True:
+                dynamodb.recorder.record('dynamodb.' + operation)
+                try:
+                    return function(self, *args, **kwargs)
+                except ClientError as ex:
+                    if ex.response['Error']['Code'] != 'ProvisionedThroughputExceededException' or attempt >= dynamodb.client_max_attempts:
+                        raise
+                time.sleep(CLIENT_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+                attempt += 1
+        return call
+    return decorator
+
+
+class FakeDynamoDb:
+    # Stands in for boto3.resource('dynamodb'), tables are created on first use with the key schema given
+
+    def __init__(self, recorder, key_schemas):
+        self.recorder = recorder
+        # Attempts the client makes for a throttled request, the importer's client only retries itself when it doesn't rate limit
+        self.client_max_attempts = 1
+        self.tables = {table_name: FakeTable(self, table_name, key_names) for table_name, key_names in key_schemas.items()}
+        self.meta = FakeResourceMeta(self)
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def consume(self, table_name, capacity, partition_key, units):
+        # Returns whether a request for the partition key (None for a whole table Scan) fits the table's throughput.
+        # capacity is 'read' or 'write', the capacity simulator overrides this to throttle requests.
+        return True
+
+    @client_call('BatchWriteItem')
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity = None, **kwargs):
+        consumed_capacity = []
+        unprocessed_items = {}
+
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error('ValidationException', 'BatchWriteItem', 'Too many items requested for the BatchWriteItem call')
+            table = self.tables[table_name]
+            units = 0
+            for request in requests:
+                item = to_dynamodb_types(request['PutRequest']['Item'])
+                item_units = get_write_units(item)
+                # Items that don't fit the throughput are handed back to be retried, the others are written
+                if self.consume(table_name, 'write', table.get_key(item)[0], item_units):
+                    table.store(item)
+                    units += item_units
+                else:
+                    unprocessed_items.setdefault(table_name, []).append(request)
+            consumed_capacity.append({'TableName': table_name, 'CapacityUnits': units})
+
+        if unprocessed_items and all(len(unprocessed_items.get(table_name, [])) == len(requests) for table_name, requests in RequestItems.items()):
+            raise client_error('ProvisionedThroughputExceededException', 'BatchWriteItem', 'The level of configured provisioned throughput for the table was exceeded')
+
+        response = {'UnprocessedItems': unprocessed_items}
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = consumed_capacity
+        return response
+
+    @client_call('BatchGetItem')
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity = None, **kwargs):
+        responses = {}
+        consumed_capacity = []
+        unprocessed_keys = {}
+
+        for table_name, request in RequestItems.items():
+            if len(request['Keys']) > 100:
+                raise client_error('ValidationException', 'BatchGetItem', 'Too many items requested for the BatchGetItem call')
+            table = self.tables[table_name]
+            keys = [table.get_key(key) for key in request['Keys']]
+            if len(set(keys)) != len(keys):
+                raise client_error('ValidationException', 'BatchGetItem', 'Provided list of item keys contains duplicates')
+
+            items = []
+            units = 0
+            for key, request_key in zip(keys, request['Keys']):
+                item = table.load(key)
+                item_units = get_read_units(item) if item is not None else 0.5
+                if not self.consume(table_name, 'read', key[0], item_units):
+                    unprocessed_keys.setdefault(table_name, {**request, 'Keys': []})['Keys'].append(request_key)
+                    continue
+                units += item_units
+                if item is not None:
+                    items.append(item)
+
+            responses[table_name] = [project(item, request.get('ProjectionExpression'), request.get('ExpressionAttributeNames')) for item in items]
+            consumed_capacity.append({'TableName': table_name, 'CapacityUnits': units})
+
+        if unprocessed_keys and all(len(unprocessed_keys.get(table_name, {}).get('Keys', [])) == len(request['Keys']) for table_name, request in RequestItems.items()):
+            raise client_error('ProvisionedThroughputExceededException', 'BatchGetItem', 'The level of configured provisioned throughput for the table was exceeded')
+
+        response = {'Responses': responses, 'UnprocessedKeys': unprocessed_keys}
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = consumed_capacity
+        return response
+
+
+class FakeResourceMeta:
+
+    def __init__(self, dynamodb):
+        self.client = FakeDynamoDbClient(dynamodb)
+
+
+class FakeDynamoDbClient:
+
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+
+    def describe_table(self, TableName):
+        self.dynamodb.recorder.record('dynamodb.DescribeTable')
+        table = self.dynamodb.tables[TableName]
+        return {'Table': {
+            'TableName': TableName,
+            'ItemCount': len(table.items),
+            'KeySchema': [{'AttributeName': key_name, 'KeyType': key_type} for key_name, key_type in zip(table.key_names, ['HASH', 'RANGE'])],
+            'ProvisionedThroughput': {'ReadCapacityUnits': table.read_capacity_units, 'WriteCapacityUnits': table.write_capacity_units}
+            }}
+
+
+class FakeTable:
+
+    def __init__(self, dynamodb, name, key_names):
+        self.dynamodb = dynamodb
+        self.name = name
+        self.key_names = tuple(key_names)
+        self.items = {}
+        self.lock = threading.Lock()
+        # 0 reports the table as on-demand
+        self.read_capacity_units = 0
+        self.write_capacity_units = 0
+
+    def get_key(self, item):
+        return tuple(item[key_name] for key_name in self.key_names)
+
+    def load(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            return copy.deepcopy(item) if item is not None else None
+
+    def store(self, item):
+        stored_item = to_dynamodb_types(item)
+        with self.lock:
+            self.items[self.get_key(stored_item)] = stored_item
+
+    def throttle_unless_consumed(self, capacity, partition_key, units, operation):
+        if not self.dynamodb.consume(self.name, capacity, partition_key, units):
+            raise client_error('ProvisionedThroughputExceededException', operation, 'The level of configured provisioned throughput for the table was exceeded')
+
+    @client_call('GetItem')
+    def get_item(self, Key, ProjectionExpression = None, ExpressionAttributeNames = None, ReturnConsumedCapacity = None, **kwargs):
+        key = tuple(to_dynamodb_types(Key)[key_name] for key_name in self.key_names)
+        item = self.load(key)
+        read_units = get_read_units(item) if item is not None else 0.5
+        self.throttle_unless_consumed('read', key[0], read_units, 'GetItem')
+
+        response = consumed(self.name, read_units, ReturnConsumedCapacity)
+        if item is not None:
+            response['Item'] = project(item, ProjectionExpression, ExpressionAttributeNames)
+        return response
+
+    @client_call('PutItem')
+    def put_item(self, Item, ConditionExpression = None, ReturnConsumedCapacity = None, **kwargs):
+        stored_item = to_dynamodb_types(Item)
+        key = self.get_key(stored_item)
+        # A put is charged even when its condition fails
+        self.throttle_unless_consumed('write', key[0], get_write_units(stored_item), 'PutItem')
+
+        with self.lock:
+            if ConditionExpression is not None and not evaluate(ConditionExpression, self.items.get(key, {})):
+                raise client_error('ConditionalCheckFailedException', 'PutItem', 'The conditional request failed')
+            self.items[key] = stored_item
+
+        return consumed(self.name, get_write_units(stored_item), ReturnConsumedCapacity)
+
+    @client_call('UpdateItem')
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames = None, ExpressionAttributeValues = None,
+                    ReturnValues = 'NONE', ReturnConsumedCapacity = None, **kwargs):
+        if not UpdateExpression.startswith('SET '):
+            raise NotImplementedError('Only SET update expressions are supported')
+
+        attribute_names = ExpressionAttributeNames or {}
+        attribute_values = to_dynamodb_types(ExpressionAttributeValues or {})
+        key = tuple(to_dynamodb_types(Key)[key_name] for key_name in self.key_names)
+
+        with self.lock:
+            old_item = self.items.get(key)
+            new_item = copy.deepcopy(old_item) if old_item is not None else dict(zip(self.key_names, key))
+            updated_old = {}
+
+            for assignment in split_assignments(UpdateExpression[len('SET '):]):
+                placeholder, value_expression = [part.strip() for part in assignment.split('=', 1)]
+                attribute_name = attribute_names.get(placeholder, placeholder)
+
+                if value_expression.startswith('if_not_exists('):
+                    _, default_placeholder = [part.strip() for part in value_expression[len('if_not_exists('):-1].split(',')]
+                    value = new_item[attribute_name] if attribute_name in new_item else attribute_values[default_placeholder]
+                else:
+                    value = attribute_values[value_expression]
+
+                if old_item is not None and attribute_name in old_item:
+                    updated_old[attribute_name] = old_item[attribute_name]
+                new_item[attribute_name] = copy.deepcopy(value)
+
+            self.throttle_unless_consumed('write', key[0], get_write_units(new_item), 'UpdateItem')
+            self.items[key] = new_item
+
+        response = consumed(self.name, get_write_units(new_item), ReturnConsumedCapacity)
+        if ReturnValues == 'UPDATED_OLD' and updated_old:
+            response['Attributes'] = updated_old
+        return response
+
+    @client_call('Query')
+    def query(self, KeyConditionExpression, FilterExpression = None, ProjectionExpression = None, ExpressionAttributeNames = None,
+              ExclusiveStartKey = None, ReturnConsumedCapacity = None, **kwargs):
+        with self.lock:
+            matching_items = [copy.deepcopy(item) for item in self.items.values() if evaluate(KeyConditionExpression, item)]
+
+        # Read capacity is charged for what the key condition matched, before the filter
+        read_units = get_read_units_for(matching_items)
+        self.throttle_unless_consumed('read', get_partition_value(KeyConditionExpression, self.key_names[0]), read_units, 'Query')
+        items = [item for item in matching_items if FilterExpression is None or evaluate(FilterExpression, item)]
+        items = [project(item, ProjectionExpression, ExpressionAttributeNames) for item in items]
+
+        response = consumed(self.name, read_units, ReturnConsumedCapacity)
+        response.update({'Items': items, 'Count': len(items), 'ScannedCount': len(matching_items)})
+        return response
+
+    @client_call('Scan')
+    def scan(self, Segment = 0, TotalSegments = 1, FilterExpression = None, ProjectionExpression = None, ExpressionAttributeNames = None,
+             ExclusiveStartKey = None, ReturnConsumedCapacity = None, **kwargs):
+        with self.lock:
+            segment_keys = sorted(key for key in self.items if get_segment(key, TotalSegments) == Segment)
+            start = 0 if ExclusiveStartKey is None else segment_keys.index(self.get_key(ExclusiveStartKey)) + 1
+            page_keys = segment_keys[start:start + SCAN_PAGE_SIZE]
+            scanned_items = [copy.deepcopy(self.items[key]) for key in page_keys]
+
+        read_units = get_read_units_for(scanned_items)
+        self.throttle_unless_consumed('read', None, read_units, 'Scan')
+        items = [item for item in scanned_items if FilterExpression is None or evaluate(FilterExpression, item)]
+        items = [project(item, ProjectionExpression, ExpressionAttributeNames) for item in items]
+
+        response = consumed(self.name, read_units, ReturnConsumedCapacity)
+        response.update({'Items': items, 'Count': len(items), 'ScannedCount': len(scanned_items)})
+        if start + SCAN_PAGE_SIZE < len(segment_keys):
+            response['LastEvaluatedKey'] = dict(zip(self.key_names, page_keys[-1]))
+        return response
+
+
+def consumed(table_name, units, return_consumed_capacity):
+    if return_consumed_capacity in ('TOTAL', 'INDEXES'):
+        return {'ConsumedCapacity': {'TableName': table_name, 'CapacityUnits': units}}
+    return {}
+
+
+def get_item_size(item):
+    return len(json.dumps(item, default = str).encode('utf-8'))
+
+
+def get_write_units(item):
+    # One write capacity unit per started KB
+    return float(max(1, math.ceil(get_item_size(item) / 1024)))
+
+
+def get_read_units(item):
+    # Half a read capacity unit per started 4 KB for eventually consistent reads
+    return max(1, math.ceil(get_item_size(item) / 4096)) / 2
+
+
+def get_read_units_for(items):
+    # Query and Scan are charged for the total size read, at least half a unit even when nothing matched
+    return max(1, math.ceil(sum(get_item_size(item) for item in items) / 4096)) / 2
+
+
+def get_segment(key, total_segments):
+    return int(hashlib.md5(json.dumps(key, default = str).encode('utf-8')).hexdigest(), 16) % total_segments
+
+
+def to_dynamodb_types(value):
+    # Numbers come back from DynamoDb as Decimal and boto3 refuses floats, both are reproduced here
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {name: to_dynamodb_types(element) for name, element in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb_types(element) for element in value]
+    if isinstance(value, set):
+        return {to_dynamodb_types(element) for element in value}
+    raise TypeError(f"Unsupported type {type(value)} for value {value!r}")
+
+
+def split_assignments(expression):
+    # Splits "a = :a, b = if_not_exists(b, :b)" on the commas outside of parentheses
+    assignments = []
+    depth = 0
+    current = ''
+    for character in expression:
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        if character == ',' and depth == 0:
+            assignments.append(current)
+            current = ''
+        else:
+            current += character
+    assignments.append(current)
+    return assignments
+
+
+def project(item, projection_expression, attribute_names):
+    if not projection_expression:
+        return item
+    names = [(attribute_names or {}).get(name.strip(), name.strip()) for name in projection_expression.split(',')]
+    return {name: value for name, value in item.items() if name in names}
+
+
+def get_partition_value(key_condition, partition_key_name):
+    # Finds the value the partition key is compared to in a Query's key condition
+    expression = key_condition.get_expression()
+    if expression['operator'] == 'AND':
+        return get_partition_value(expression['values'][0], partition_key_name) or get_partition_value(expression['values'][1], partition_key_name)
+    if expression['operator'] == '=' and expression['values'][0].name == partition_key_name:
+        return to_dynamodb_types(expression['values'][1])
+    return None
+
+
+def evaluate(condition, item):
+    # Evaluates a boto3 Key/Attr condition against an item
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if operator == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+    if operator == 'attribute_exists':
+        return values[0].name in item
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+
+    attribute_value = item.get(values[0].name)
+    operands = [to_dynamodb_types(value) for value in values[1:]]
+    if attribute_value is None:
+        return False
+    if operator == 'begins_with':
+        return isinstance(attribute_value, str) and attribute_value.startswith(operands[0])
+    if operator == 'BETWEEN':
+        return comparable(attribute_value, operands[0]) and operands[0] <= attribute_value <= operands[1]
+    if not comparable(attribute_value, operands[0]):
+        # DynamoDb compares values of different types as not matching
+        return operator == '<>'
+    if operator == '=':
+        return attribute_value == operands[0]
+    if operator == '<>':
+        return attribute_value != operands[0]
+    if operator == '<':
+        return attribute_value < operands[0]
+    if operator == '<=':
+        return attribute_value <= operands[0]
+    if operator == '>':
+        return attribute_value > operands[0]
+    if operator == '>=':
+        return attribute_value >= operands[0]
+    raise NotImplementedError(f"Condition operator {operator} isn't supported")
+
+
+def comparable(first, second):
+    return isinstance(first, Decimal) == isinstance(second, Decimal) and isinstance(first, str) == isinstance(second, str)
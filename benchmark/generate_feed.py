@@ -0,0 +1,110 @@
+# Generates synthetic contentFeed.json files shaped like the real feed, with controllable numbers of movies,
+# tv shows, seasons and episodes. Used by the benchmarks and can be run on its own:
+#
+#   python benchmark/generate_feed.py --movies 5000 --tv-shows 200 --seasons 5 --episodes 12 --output contentFeed.json
+
+import argparse
+import copy
+import json
+import random
+
+
+GENRES = ['Action', 'Comedy', 'Documentary', 'Drama', 'Horror', 'Kids', 'Romance', 'Science Fiction', 'Thriller']
+RATINGS = ['G', 'PG', 'PG-13', 'R', 'TV-Y', 'TV-PG', 'TV-14', 'TV-MA']
+
+# Season titles other than numbers, these get a different seasonAndEpisode format in the importer
+SPECIAL_SEASONS = ['Pilot', 'Extras', 'Mini Series']
+
+
+def generate_feed(movies, tv_shows, seasons, episodes, seed = 0, special_season_percent = 10):
+    generator = random.Random(seed)
+
+    feed = {
+        'Movies': [generate_media(generator, f"Movie {index:06}") for index in range(movies)],
+        'TV Shows': []
+        }
+
+    for index in range(tv_shows):
+        tv_show = generate_media(generator, f"TV Show {index:05}")
+        tv_show['seasons'] = []
+        for season_number in range(1, seasons + 1):
+            tv_show['seasons'].append({
+                'title': str(season_number),
+                'episodes': [generate_episode(generator, tv_show, season_number, episode_number) for episode_number in range(1, episodes + 1)]
+                })
+        if generator.uniform(0, 100) < special_season_percent:
+            tv_show['seasons'].append({
+                'title': generator.choice(SPECIAL_SEASONS),
+                'episodes': [generate_episode(generator, tv_show, 0, episode_number) for episode_number in range(1, 3)]
+                })
+        feed['TV Shows'].append(tv_show)
+
+    return feed
+
+
+def change_feed(feed, changed_percent = 0, new_percent = 0, seed = 1):
+    # Returns a copy of the feed with a share of its records changed and new records added, like the next day's feed
+    generator = random.Random(seed)
+    changed_feed = copy.deepcopy(feed)
+
+    records = changed_feed['Movies'] + changed_feed['TV Shows'] + [
+        episode for tv_show in changed_feed['TV Shows'] for season in tv_show['seasons'] for episode in season['episodes']
+        ]
+    for record in generator.sample(records, round(len(records) * changed_percent / 100)):
+        record['longDescription'] += ' Updated.'
+        record['rating'] = generator.choice(RATINGS)
+
+    for index in range(round(len(feed['Movies']) * new_percent / 100)):
+        changed_feed['Movies'].append(generate_media(generator, f"New Movie {index:06}"))
+    for tv_show in changed_feed['TV Shows'][:round(len(feed['TV Shows']) * new_percent / 100)]:
+        season = tv_show['seasons'][-1]
+        season['episodes'].append(generate_episode(generator, tv_show, 0, len(season['episodes']) + 1))
+
+    return changed_feed
+
+
+def generate_media(generator, title):
+    year = generator.randint(1950, 2025)
+    return {
+        'title': title,
+        'longDescription': ' '.join(generator.choice(['A', 'story', 'about', 'the', 'night', 'city', 'family', 'secret', 'journey']) for _ in range(40)),
+        'shortDescription': f"{title}, a {generator.choice(GENRES).lower()} from {year}.",
+        'thumbnail': f"https://cdn.example.com/thumbnails/{title.replace(' ', '-').lower()}.jpg",
+        'rating': generator.choice(RATINGS),
+        'cast': [f"Actor {generator.randint(1, 5000)}" for _ in range(generator.randint(2, 8))],
+        'director': f"Director {generator.randint(1, 500)}",
+        'genres': generator.sample(GENRES, generator.randint(1, 3)),
+        'releaseDate': f"{year}-{generator.randint(1, 12):02}-{generator.randint(1, 28):02}",
+        'content': {
+            'duration': generator.randint(1200, 9000),
+            'videos': [{'videoType': 'HLS', 'url': f"https://cdn.example.com/videos/{title.replace(' ', '-').lower()}/master.m3u8"}]
+            }
+        }
+
+
+def generate_episode(generator, tv_show, season_number, episode_number):
+    episode = generate_media(generator, f"{tv_show['title']} S{season_number:02}E{episode_number:02}")
+    episode['episodeNumber'] = episode_number
+    return episode
+
+
+def count_records(feed):
+    return len(feed['Movies']) + len(feed['TV Shows']) + sum(
+        len(season['episodes']) for tv_show in feed['TV Shows'] for season in tv_show['seasons']
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic contentFeed.json')
+    parser.add_argument('--movies', type = int, default = 1000)
+    parser.add_argument('--tv-shows', type = int, default = 50)
+    parser.add_argument('--seasons', type = int, default = 4)
+    parser.add_argument('--episodes', type = int, default = 10, help = 'episodes per season')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'contentFeed.json')
+    arguments = parser.parse_args()
+
+    feed = generate_feed(arguments.movies, arguments.tv_shows, arguments.seasons, arguments.episodes, arguments.seed)
+    with open(arguments.output, 'w') as file:
+        json.dump(feed, file)
+    print(f"Wrote {count_records(feed)} records to {arguments.output}")
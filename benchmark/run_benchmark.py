@@ -0,0 +1,232 @@
+# Runs the importer against the in-memory S3 and DynamoDb stand-ins in benchmark/fakes.py with a synthetic feed and
+# reports records/sec, API calls per record, peak RSS and wall time for each importer mode.
+#
+#   python benchmark/run_benchmark.py --movies 2000 --tv-shows 100 --latency-ms 5
+#   python benchmark/run_benchmark.py --scenario reimport --changed-percent 5 --modes original default upsert
+#
+# Each mode runs in its own process so the peak RSS of one doesn't hide the others.
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+IMPORTER_PATH = os.path.join(os.path.dirname(BENCHMARK_DIRECTORY), 'import-json-to-dynamodb.py')
+
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+
+import fakes
+import generate_feed
+
+
+# Configuration of the importer turning all of the optimizations off, the way it imported records originally
+ORIGINAL_CONFIGURATION = {
+    'SKIP_UNCHANGED_FEED': False,
+    'CACHE_LOOKUPS': False,
+    'WARM_KEY_CACHE': False,
+    'CHECKPOINT_BEFORE_TIMEOUT': False,
+    'STREAM_JSON_FEED': False,
+    'INSERT_ONLY_CONDITIONAL_PUTS': False,
+    'UPSERT_WITH_UPDATE_ITEM': False,
+    'USE_BATCH_WRITES': False,
+    'PREFETCH_EXISTING_RECORDS': False,
+    'LOAD_EPISODE_INDEX_PER_SHOW': False,
+    'SKIP_UNCHANGED_RECORDS': False,
+    'CONCURRENT_WRITES': False,
+    'CONCURRENT_SECTIONS': False,
+    'SCHEDULE_EPISODE_WRITES': False,
+    'RATE_LIMIT_REQUESTS': False,
+    'TRACK_CONSUMED_CAPACITY': False,
+    'EMIT_IMPORT_METRICS': False
+}
+
+# Records of every table are updated from the feed in the modes below, the importer's default only inserts new records
+UPDATE_EXISTING_DATA = {
+    'UPDATE_EXISTING_MOVIE_DATA': True,
+    'UPDATE_EXISTING_TV_DATA': True,
+    'UPDATE_EXISTING_EPISODE_DATA': True
+}
+
+# Configuration overrides of each importer mode, applied to the importer's own defaults
+MODES = {
+    'original': ORIGINAL_CONFIGURATION,
+    'default': {},
+    'lookups': {**UPDATE_EXISTING_DATA, 'UPSERT_WITH_UPDATE_ITEM': False},
+    'upsert': UPDATE_EXISTING_DATA,
+    'startup-scan': {**UPDATE_EXISTING_DATA, 'UPSERT_WITH_UPDATE_ITEM': False, 'SCAN_EXISTING_KEYS_AT_STARTUP': True},
+    'local-mirror': {**UPDATE_EXISTING_DATA, 'UPSERT_WITH_UPDATE_ITEM': False, 'USE_LOCAL_MIRROR': True},
+    'key-filters': {**UPDATE_EXISTING_DATA, 'UPSERT_WITH_UPDATE_ITEM': False, 'USE_KEY_FILTERS': True},
+    'changed-only': {'IMPORT_CHANGED_RECORDS_ONLY': True}
+}
+
+
+class BenchmarkContext:
+    # Stands in for the Lambda context, the import never runs out of time
+
+    function_name = 'import-json-to-dynamodb-benchmark'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:000000000000:function:import-json-to-dynamodb-benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+
+def load_importer():
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    specification = importlib.util.spec_from_file_location('importer', IMPORTER_PATH)
+    importer = importlib.util.module_from_spec(specification)
+    sys.modules['importer'] = importer
+    specification.loader.exec_module(importer)
+    return importer
+
+
+def install_fakes(importer, recorder, fake_dynamodb = None):
+    # Points the importer's clients at the stand-ins, returns them so the benchmark can seed and inspect them
+    fake_s3 = fakes.FakeS3(recorder)
+    fake_dynamodb = fake_dynamodb or fakes.FakeDynamoDb(recorder, importer.TABLE_KEYS)
+
+    importer.s3 = fake_s3
+    importer.dynamodb = fake_dynamodb
+    importer.movie_table = fake_dynamodb.Table(importer.MOVIE_TABLE)
+    importer.tv_show_table = fake_dynamodb.Table(importer.TV_SHOW_TABLE)
+    importer.episode_table = fake_dynamodb.Table(importer.EPISODE_TABLE)
+    importer.lambda_client = None
+    return fake_s3, fake_dynamodb
+
+
+def configure(importer, overrides, work_directory):
+    for name, value in overrides.items():
+        if not hasattr(importer, name):
+            raise ValueError(f"The importer has no configuration named {name}")
+        setattr(importer, name, value)
+
+    importer.LOCAL_MIRROR_PATH = os.path.join(work_directory, 'content-mirror.sqlite3')
+    importer.DIFF_WORK_DIRECTORY = work_directory
+
+
+def run_import(importer, event):
+    # Runs one invocation with the importer's output discarded, it prints a line per record
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            return importer.lambda_handler(event, BenchmarkContext())
+        finally:
+            sys.stdout = stdout
+
+
+def run_mode(mode, arguments):
+    # Runs the import of a single mode in this process and returns its measurements
+    importer = load_importer()
+    recorder = fakes.CallRecorder(arguments.latency_ms / 1000, arguments.jitter_ms / 1000)
+    fake_s3, fake_dynamodb = install_fakes(importer, recorder)
+    work_directory = tempfile.mkdtemp(prefix = 'import-benchmark-')
+
+    feed = generate_feed.generate_feed(arguments.movies, arguments.tv_shows, arguments.seasons, arguments.episodes, arguments.seed)
+
+    if arguments.scenario == 'reimport':
+        # The tables and the importer's state objects start out holding the previous feed, imported with the same mode
+        configure(importer, MODES[mode], work_directory)
+        fake_s3.put_feed(importer.JSON_FILE, feed)
+        run_import(importer, {})
+        feed = generate_feed.change_feed(feed, arguments.changed_percent, arguments.new_percent, arguments.seed + 1)
+        recorder.calls.clear()
+    else:
+        configure(importer, MODES[mode], work_directory)
+
+    fake_s3.put_feed(importer.JSON_FILE, feed)
+    records = generate_feed.count_records(feed)
+
+    started = time.perf_counter()
+    result = run_import(importer, {})
+    wall_time = time.perf_counter() - started
+
+    dynamodb_calls = {name: count for name, count in recorder.calls.items() if name.startswith('dynamodb.')}
+    return {
+        'mode': mode,
+        'scenario': arguments.scenario,
+        'status': result['status'],
+        'records': records,
+        'wall_time_seconds': round(wall_time, 3),
+        'records_per_second': round(records / wall_time, 1) if wall_time else None,
+        'api_calls': sum(recorder.calls.values()),
+        'api_calls_per_record': round(sum(dynamodb_calls.values()) / records, 3) if records else None,
+        'calls': dict(sorted(recorder.calls.items())),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'items': {table_name: len(table.items) for table_name, table in fake_dynamodb.tables.items()}
+        }
+
+
+def run_benchmark(arguments):
+    results = []
+    for mode in arguments.modes:
+        command = [sys.executable, os.path.abspath(__file__), '--run-mode', mode] + forward_arguments(arguments)
+        completed = subprocess.run(command, capture_output = True, text = True)
+        if completed.returncode != 0:
+            print(f"Mode {mode} failed:\n{completed.stderr}", file = sys.stderr)
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def forward_arguments(arguments):
+    return [
+        '--movies', str(arguments.movies), '--tv-shows', str(arguments.tv_shows),
+        '--seasons', str(arguments.seasons), '--episodes', str(arguments.episodes), '--seed', str(arguments.seed),
+        '--latency-ms', str(arguments.latency_ms), '--jitter-ms', str(arguments.jitter_ms),
+        '--scenario', arguments.scenario,
+        '--changed-percent', str(arguments.changed_percent), '--new-percent', str(arguments.new_percent)
+        ]
+
+
+def print_results(results):
+    columns = [
+        ('mode', 'Mode', '<14'),
+        ('status', 'Status', '<10'),
+        ('records', 'Records', '>8'),
+        ('wall_time_seconds', 'Wall s', '>9'),
+        ('records_per_second', 'Records/s', '>10'),
+        ('api_calls_per_record', 'Calls/rec', '>10'),
+        ('peak_rss_mb', 'RSS MB', '>8')
+        ]
+    print('  '.join(format(title, alignment) for _, title, alignment in columns))
+    for result in results:
+        print('  '.join(format(str(result[name]), alignment) for name, _, alignment in columns))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Benchmark the importer modes against in-memory S3 and DynamoDb')
+    parser.add_argument('--modes', nargs = '+', choices = list(MODES), default = list(MODES))
+    parser.add_argument('--movies', type = int, default = 1000)
+    parser.add_argument('--tv-shows', type = int, default = 50)
+    parser.add_argument('--seasons', type = int, default = 4)
+    parser.add_argument('--episodes', type = int, default = 10, help = 'episodes per season')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--latency-ms', type = float, default = 2, help = 'simulated round trip time of every API call')
+    parser.add_argument('--jitter-ms', type = float, default = 0, help = 'random extra latency of up to this much per call')
+    parser.add_argument('--scenario', choices = ['new', 'reimport'], default = 'new',
+                        help = "'new' imports into empty tables, 'reimport' imports a changed feed over the previous one")
+    parser.add_argument('--changed-percent', type = float, default = 5, help = 'share of records changed in the reimport scenario')
+    parser.add_argument('--new-percent', type = float, default = 1, help = 'share of records added in the reimport scenario')
+    parser.add_argument('--json', action = 'store_true', help = 'print the results as JSON')
+    parser.add_argument('--run-mode', help = argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    if arguments.run_mode:
+        print(json.dumps(run_mode(arguments.run_mode, arguments)))
+    else:
+        results = run_benchmark(arguments)
+        if arguments.json:
+            print(json.dumps(results, indent = 2))
+        else:
+            print_results(results)
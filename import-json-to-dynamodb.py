@@ -1,7 +1,29 @@
+import codecs
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
-from datetime import datetime
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 
 
 MOVIE_TABLE = 'movies'
@@ -11,6 +33,22 @@ EPISODE_TABLE = 'episodes'
 S3_BUCKET = 'video-content-bucket-1'
 JSON_FILE = 'contentFeed.json'
 
+# S3 object in S3_BUCKET recording the ETag and version of the last feed that was imported successfully
+IMPORT_STATE_KEY = 'contentFeed.import-state.json'
+
+# S3 object in S3_BUCKET holding the sorted digest of the last feed that was imported successfully
+FEED_DIGEST_KEY = 'contentFeed.digest.tsv'
+
+# S3 object in S3_BUCKET holding the cursor of an import that stopped before the Lambda timeout
+CHECKPOINT_STATE_KEY = 'contentFeed.checkpoint.json'
+
+# S3 object in S3_BUCKET holding the shards of a FAN_OUT_IMPORT coordinator that stopped before the Lambda timeout
+# and the results it merged so far
+FAN_OUT_STATE_KEY = 'contentFeed.fan-out.json'
+
+# Prefix of the S3 objects in S3_BUCKET the workers of the 'lambda' dispatcher save their result to
+FAN_OUT_RESULT_KEY_PREFIX = 'contentFeed.fan-out-results/'
+
 
 # Set to True to update all Movie fields except dateAdded, lastWatched, and views
 # Set to False to only add new movies
@@ -24,229 +62,3121 @@ UPDATE_EXISTING_TV_DATA = False
 # Set to False to only add episodes
 UPDATE_EXISTING_EPISODE_DATA = False
 
+# Set to True to skip the whole import when the feed hasn't changed since the last successful import,
+# checked with a conditional GET against the ETag in IMPORT_STATE_KEY so an unchanged feed costs a single request
+# Set to False to import the feed on every run
+SKIP_UNCHANGED_FEED = True
+
+# Set to True to import the feed and every record in it even if they haven't changed, e.g. for backfills or to put back
+# records deleted from the tables. A single run can also be forced
+# by invoking the function with {"force": true} as the event
+FORCE_IMPORT = False
+
+# Set to True to keep the responses of record lookups for the rest of the invocation, including lookups that found
+# nothing, so a record repeated in the feed or looked up again isn't queried twice. Entries of a partition key are
+# dropped whenever the importer writes to it.
+# Set to False to query DynamoDb for every lookup
+CACHE_LOOKUPS = True
+
+# Number of lookup responses kept when CACHE_LOOKUPS is True, the least recently used are dropped first
+LOOKUP_CACHE_SIZE = 10000
+
+# Set to True to remember across invocations of a warm container which records exist, so importing the same feed
+# again (a continuation, a shard, a forced run or a retry after failures) doesn't check them again for tables where
+# only new records are added. Forgotten when the feed changes and after WARM_KEY_CACHE_TTL_SECONDS, since records
+# can be deleted outside of the import.
+# Set to False to only know about existing records within one invocation
+WARM_KEY_CACHE = True
+WARM_KEY_CACHE_TTL_SECONDS = 3600
+
+# Keys remembered at most when WARM_KEY_CACHE is True, the least recently confirmed are forgotten first
+WARM_KEY_CACHE_MAX_KEYS = 200000
+
+# Set to True to stop taking new records when the invocation is about to time out, save a cursor of how far each
+# section got (movie, or tv show / season / episode) and carry on from exactly there in the next invocation
+# Set to False to let long imports run into the Lambda timeout
+CHECKPOINT_BEFORE_TIMEOUT = True
+
+# Time left in the invocation at which the import stops and checkpoints, has to cover finishing the records in flight
+CHECKPOINT_SAFETY_MARGIN_MS = 60000
+
+# Set to True to invoke the function again asynchronously with the cursor after a checkpoint
+# Set to False to only save the cursor and return it, the next scheduled run then picks it up
+CONTINUE_IN_NEW_INVOCATION = True
+
+# Set to True to run as a coordinator that splits the feed into shards and hands each shard to a worker, which downloads
+# only its byte range of the feed and imports it with the same create/update functions. The coordinator adds up the
+# workers' results, and when it runs out of time it saves its shards in FAN_OUT_STATE_KEY and continues from there.
+# Set to False to import the whole feed in this invocation
+FAN_OUT_IMPORT = False
+
+# Records per shard for each section, TV shows are split by show so a show always stays in one shard with its episodes
+FAN_OUT_SHARD_SIZES = {
+    'Movies': 500,
+    'TV Shows': 25
+}
+
+# Number of shards being imported at the same time
+FAN_OUT_WORKERS = 8
+
+# 'lambda' invokes the function once per shard, 'process' imports the shards in a local process pool (tests and CLI runs)
+FAN_OUT_DISPATCHER = 'lambda'
+
+# Function invoked for the shards, None for the coordinator's own function
+FAN_OUT_FUNCTION_NAME = None
+
+# Seconds between checks for the results the workers of the 'lambda' dispatcher save in S3
+FAN_OUT_POLL_SECONDS = 5
+
+# Seconds after which a shard without a result counts as failed, a little more than the longest Lambda timeout
+FAN_OUT_SHARD_TIMEOUT_SECONDS = 960
+
+# Set to True to parse the feed incrementally from the S3 stream, one movie or tv show at a time,
+# so peak memory depends on the largest single record rather than the size of the whole feed
+# Set to False to read and parse the whole feed in one go
+STREAM_JSON_FEED = True
+
+# Number of bytes read from the S3 stream at a time when STREAM_JSON_FEED is True
+FEED_READ_CHUNK_SIZE = 64 * 1024
+
+# Set to True to skip the existence lookup for tables whose UPDATE_EXISTING_* flag is False and insert new records
+# with a put conditioned on attribute_not_exists, records that are already present are counted and left untouched
+# Set to False to look up every record before deciding whether to write it
+INSERT_ONLY_CONDITIONAL_PUTS = True
+
+# Set to True to apply updates for tables whose UPDATE_EXISTING_* flag is True with a single UpdateItem per record
+# that sets the feed fields and only sets dateAdded, lastWatched, views and trailerUrl if they don't exist yet,
+# so no read is needed beforehand and concurrent changes to the preserved fields are never overwritten
+# Set to False to look up every record and write it back in full with the preserved fields copied over
+UPSERT_WITH_UPDATE_ITEM = True
+
+# Set to True to group writes per table into BatchWriteItem requests of up to 25 items,
+# BatchWriteItem can't carry conditions so insert-only tables always use conditional put_item calls
+# Set to False to write every record with its own put_item call
+USE_BATCH_WRITES = True
+
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_WRITE_SIZE = 25
+
+# Retries for items DynamoDB returns as UnprocessedItems, backing off exponentially between attempts
+BATCH_WRITE_MAX_RETRIES = 8
+
+# Set to True to look up existing records with BatchGetItem calls of up to 100 keys before they are processed
+# Set to False to run a Query for every movie, tv show and episode
+PREFETCH_EXISTING_RECORDS = True
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+# Retries for keys DynamoDB returns as UnprocessedKeys, backing off exponentially between attempts
+BATCH_GET_MAX_RETRIES = 8
+
+# Set to True to load all existing episodes of a tv show with one paginated Query on tvShowName before its episodes
+# are processed, this replaces the per-episode lookups and the episode part of PREFETCH_EXISTING_RECORDS
+# Set to False to look up episodes one by one (or through the prefetch)
+LOAD_EPISODE_INDEX_PER_SHOW = True
+
+# Set to True to build an in-memory index of every existing record before the import starts, using a parallel Scan
+# of each table that still needs lookups, meant for full catalogue reimports where nearly every record already exists.
+# The index holds the key and preserved fields only and answers the get_dynamo_record_* lookups without any reads.
+# Not used with FAN_OUT_IMPORT, every shard would scan the whole tables.
+# Set to False to look up records while importing
+SCAN_EXISTING_KEYS_AT_STARTUP = False
+
+# Number of parallel Scan segments per table when SCAN_EXISTING_KEYS_AT_STARTUP is True
+SCAN_TOTAL_SEGMENTS = 8
+
+# Most records indexed per table, if a table has more its index is dropped and records are looked up while importing
+SCAN_MAX_INDEXED_ITEMS = 1000000
+
+# Set to True to keep the key and preserved fields of every record of the tables that still need lookups in a SQLite
+# database in /tmp and answer the lookups from it, like the startup Scan index but on disk and kept between
+# invocations of a warm container. The first invocation builds it with a parallel Scan, later ones only fetch the
+# records added or watched since the previous refresh, and none within LOCAL_MIRROR_REUSE_SECONDS of it.
+# Takes the place of SCAN_EXISTING_KEYS_AT_STARTUP.
+# A refresh is still a Scan of the whole table with a filter, DynamoDb charges the read capacity of every record it
+# reads and not just of those it returns, so it costs as much capacity as building the mirror again. It only saves
+# transferring and storing the records that didn't change. Leave this off for tables whose Scan costs more than the
+# lookups of an import.
+# Set to False to look up records in DynamoDb
+USE_LOCAL_MIRROR = False
+LOCAL_MIRROR_PATH = '/tmp/content-mirror.sqlite3'
+
+# Seconds after which the mirror is built again instead of refreshed. Records deleted, or changed outside of the import
+# without a newer dateAdded or lastWatched, are only picked up by a rebuild.
+LOCAL_MIRROR_MAX_AGE_SECONDS = 24 * 3600
+
+# Seconds a refresh reaches back before the previous refresh started, covers writes in flight and clock differences
+LOCAL_MIRROR_REFRESH_OVERLAP_SECONDS = 300
+
+# Seconds after a refresh in which the mirror is used as it is without scanning again, as long as the import that used
+# it last completed without failures. Saves the Scan of continuations and of imports shortly after each other, records
+# added or watched outside of the import within this window aren't seen until the next refresh. 0 refreshes every time.
+LOCAL_MIRROR_REUSE_SECONDS = 900
+
+# Set to True to keep a Bloom filter of the keys of every table that still needs lookups in S3 next to the feed.
+# A key the filter never saw definitely doesn't exist, so the record is written straight away without a lookup,
+# with a condition that stops it from overwriting a record the filter doesn't know about. A record failing that
+# condition means the filter drifted from the table, it's then built again by the next import.
+# Set to False to look up every record
+USE_KEY_FILTERS = False
+
+# Prefix of the S3 objects in S3_BUCKET holding the filter of each table, followed by the table name
+KEY_FILTER_KEY_PREFIX = 'contentFeed.key-filter.'
+
+# Share of keys that don't exist which the filter still reports as possibly existing, these are looked up as before
+KEY_FILTER_FALSE_POSITIVE_RATE = 0.01
+
+# Keys a filter is sized for, KEY_FILTER_CAPACITY_FACTOR times the records of the table when it's built but at least
+# KEY_FILTER_MIN_CAPACITY. It's built again once it holds more keys than that.
+KEY_FILTER_MIN_CAPACITY = 100000
+KEY_FILTER_CAPACITY_FACTOR = 2
+
+# The filter is also built again when the table's item count exceeds the keys in the filter by more than this share
+KEY_FILTER_DRIFT_TOLERANCE = 0.05
+
+# Set to True to skip records whose feed data hasn't changed since they were last written, without reading or writing
+# anything in DynamoDb. A hash of the feed fields of every record written is kept in FINGERPRINT_STATE_KEY next to the feed.
+# Delete that object to make the next import process every record again.
+# Set to False to process every record in the feed
+SKIP_UNCHANGED_RECORDS = True
+
+# S3 object in S3_BUCKET holding the record fingerprints between imports
+FINGERPRINT_STATE_KEY = 'contentFeed.fingerprints.json'
+
+# A fingerprint is only trusted for this long after the record was last written or found in the table. Records can be
+# deleted outside of the import, an older fingerprint makes the record go through DynamoDb again so it's put back.
+FINGERPRINT_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+# Set to True to diff the feed against the digest of the previously imported feed, keyed on title + releaseDate for
+# movies, title for tv shows and title + season + episodeNumber for episodes, and only import records that were added
+# or changed. The feed is spooled to DIFF_WORK_DIRECTORY and both digests are compared with an external sort-merge,
+# so this works for feeds larger than memory. Tv shows are passed on with only their added or changed episodes.
+# Set to False to pass every record in the feed on to the import
+IMPORT_CHANGED_RECORDS_ONLY = False
+
+# Digest lines sorted in memory at a time before being merged from disk
+DIFF_SORT_RUN_SIZE = 200000
+
+# Directory for the spooled feed and the digest files, Lambda's ephemeral storage
+DIFF_WORK_DIRECTORY = '/tmp'
+
+# Number of movies or tv shows read from the feed and prefetched together, keeps memory bounded when streaming.
+# Without anything to prefetch records are taken off the feed one at a time as they are submitted.
+PREFETCH_WINDOW_SIZE = 100
+
+# Backoff between retries of unprocessed items/keys, doubles on every attempt up to the maximum
+RETRY_BASE_BACKOFF_SECONDS = 0.05
+RETRY_MAX_BACKOFF_SECONDS = 5
+
+# Set to True to process records on a pool of worker threads per table so DynamoDb requests overlap
+# Set to False to process every record on the handler's thread one after another
+CONCURRENT_WRITES = True
+
+# Number of worker threads issuing DynamoDb requests for each table when CONCURRENT_WRITES is True
+TABLE_WORKERS = {
+    MOVIE_TABLE: 8,
+    TV_SHOW_TABLE: 4,
+    EPISODE_TABLE: 16
+}
+
+# Records waiting for a worker per table, the feed reader blocks once a table's queue is full
+TABLE_QUEUE_SIZE = 100
+
+# Set to True to import the Movies and TV Shows sections at the same time, and several tv shows at the same time,
+# the sections write to different tables so the import takes as long as the slower section instead of both combined
+# Set to False to import the sections one after the other
+CONCURRENT_SECTIONS = True
+
+# Number of tv shows processed at the same time when CONCURRENT_SECTIONS is True
+TV_SHOW_SECTION_WORKERS = 4
+
+# Records buffered per section between the feed reader and the section's importer when CONCURRENT_SECTIONS is True
+# and the sections come from one stream, like the changed records of IMPORT_CHANGED_RECORDS_ONLY. A later section
+# only starts once all but this many records of the earlier one were taken. A streamed feed is downloaded once per
+# section instead, and a feed parsed in memory is handed to the importers as is, so their sections fully overlap.
+SECTION_BUFFER_SIZE = 1000
+
+# Set to True to interleave the episodes of several tv shows round-robin. All episodes of a show share the partition
+# key tvShowName, so writing them back to back puts the whole load on one partition while the others sit idle.
+# Set to False to write the episodes of each show one after the other
+SCHEDULE_EPISODE_WRITES = True
+
+# Number of tv shows whose episodes are interleaved at a time when SCHEDULE_EPISODE_WRITES is True
+EPISODE_SCHEDULER_SHOWS = 16
+
+# Episodes of one tv show being processed at the same time when SCHEDULE_EPISODE_WRITES is True
+EPISODE_PARTITION_MAX_IN_FLIGHT = 2
+
+# Set to True to pace every DynamoDb request of the importer with a token bucket per table for reads and for writes.
+# The bucket is charged the capacity DynamoDb reports as consumed and its rate is halved on throttling, then grows
+# back slowly (AIMD). boto3 doesn't retry requests itself then, so throttling reaches the limiter instead of being hidden,
+# the importer retries throttled requests, DynamoDb server errors and connection errors instead.
+# Set to False to send requests as fast as the workers produce them and leave retries to boto3
+RATE_LIMIT_REQUESTS = True
+
+# Share of each table's provisioned read and write capacity the import may use, the rest is left to the application
+RATE_LIMIT_CAPACITY_PERCENT = 50
+
+# Capacity units per second the percentage applies to for on-demand tables, which have no provisioned capacity
+RATE_LIMIT_ON_DEMAND_CAPACITY = {
+    'read': 12000,
+    'write': 4000
+}
+
+# Factor the rate is multiplied by on throttling, and share of the target rate added back every second without throttling
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+RATE_LIMIT_INCREASE_PERCENT = 5
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-movie_table = dynamodb.Table(MOVIE_TABLE)
-tv_show_table = dynamodb.Table(TV_SHOW_TABLE)
-episode_table = dynamodb.Table(EPISODE_TABLE)
+# Lowest rate in capacity units per second the limiter backs off to
+RATE_LIMIT_MIN_RATE = 1
+
+# Retries of a request that was throttled, failed on the DynamoDb side or lost its connection when RATE_LIMIT_REQUESTS is True
+RATE_LIMIT_MAX_RETRIES = 10
+
+# Set to True to print the phase timings, record counts, API latencies and throughput of every run as CloudWatch
+# Embedded Metric Format, CloudWatch Logs turns the lines into metrics that can be graphed without parsing the logs
+# Set to False to only print the record counts
+EMIT_IMPORT_METRICS = True
+
+# CloudWatch namespace of the import metrics
+IMPORT_METRICS_NAMESPACE = 'ContentFeedImport'
+
+# Set to True to have every DynamoDb request return the capacity it consumed and print the read and write capacity
+# units used per table for lookups, inserts and updates with the estimated on-demand cost at the end of the run
+# Set to False to only request the consumed capacity when RATE_LIMIT_REQUESTS needs it
+TRACK_CONSUMED_CAPACITY = True
+
+# On-demand price in USD per million read and write request units used for the estimated cost (us-east-1, standard table class)
+ON_DEMAND_PRICE_PER_MILLION_UNITS = {
+    'read': 0.125,
+    'write': 0.625
+}
+
+# Primary key attributes of each table, checked against the key schema of the tables in DynamoDb on a cold start
+TABLE_KEYS = {
+    MOVIE_TABLE: ('name', 'year'),
+    TV_SHOW_TABLE: ('name',),
+    EPISODE_TABLE: ('tvShowName', 'seasonAndEpisode')
+}
+
+# Fields of existing records that are kept when a record is updated from the feed
+PRESERVED_FIELDS = {
+    MOVIE_TABLE: ('trailerUrl', 'dateAdded', 'lastWatched', 'views'),
+    TV_SHOW_TABLE: ('dateAdded', 'lastWatched', 'views'),
+    EPISODE_TABLE: ('dateAdded', 'lastWatched', 'views')
+}
+
+
+class ThreadLocalResource:
+    # Stands in for a boto3 DynamoDb resource and passes every attribute on to a resource of the calling thread.
+    # A thread takes the resource of a thread that ended if there is one, so the worker threads of every invocation
+    # reuse the resources of the previous ones and only as many are created as threads ever ran at the same time.
+
+    def __init__(self, create_resource):
+        self.create_resource = create_resource
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (resource, tables) given back by threads that ended
+        self.idle_resources = []
+        self.resources_created = 0
+
+    def get_resource(self):
+        if not hasattr(self.local, 'resource'):
+            with self.lock:
+                if self.idle_resources:
+                    resource, tables = self.idle_resources.pop()
+                else:
+                    # Created under the lock, the session they come from isn't thread safe
+                    resource, tables = self.create_resource(), {}
+                    self.resources_created += 1
+
+            # The lease is dropped with the thread's locals when the thread ends, which gives the resource back
+            self.local.lease = ResourceLease()
+            weakref.finalize(self.local.lease, self._give_back, resource, tables)
+            self.local.resource = resource
+            self.local.tables = tables
+        return self.local.resource
+
+    def _give_back(self, resource, tables):
+        with self.lock:
+            self.idle_resources.append((resource, tables))
+
+    def get_table(self, table_name):
+        resource = self.get_resource()
+        if table_name not in self.local.tables:
+            self.local.tables[table_name] = resource.Table(table_name)
+        return self.local.tables[table_name]
+
+    def Table(self, table_name):
+        return ThreadLocalTable(self, table_name)
+
+    def __getattr__(self, name):
+        return getattr(self.get_resource(), name)
+
+
+class ResourceLease:
+    # Held in the thread locals of a ThreadLocalResource for as long as the thread uses its resource
+    pass
+
+
+class ThreadLocalTable:
+    # Stands in for a Table of a ThreadLocalResource, the calling thread's own Table handles every request
+
+    def __init__(self, resource, table_name):
+        self.resource = resource
+        self.name = table_name
+
+    def __getattr__(self, name):
+        return getattr(self.resource.get_table(self.name), name)
+
+
+def create_clients():
+    # Also called in every process of the 'process' fan out dispatcher, connections can't be shared with a forked process
+    global s3, lambda_client, dynamodb, movie_table, tv_show_table, episode_table
+
+    s3 = boto3.client('s3')
+    lambda_client = boto3.client('lambda')
+    # boto3 resources aren't thread safe, every thread uses its own, all created from one session. With the rate limiter
+    # throttled requests, server errors and connection errors are retried by call_rate_limited so it sees every throttle.
+    dynamodb_session = boto3.session.Session()
+    dynamodb = ThreadLocalResource(lambda: dynamodb_session.resource('dynamodb', config = Config(
+        retries = {'mode': 'standard', 'max_attempts': 1} if RATE_LIMIT_REQUESTS else None
+        )))
+    movie_table = dynamodb.Table(MOVIE_TABLE)
+    tv_show_table = dynamodb.Table(TV_SHOW_TABLE)
+    episode_table = dynamodb.Table(EPISODE_TABLE)
+
+
+create_clients()
+
+# BatchWriter per table name for the current invocation, flushed at the end of each section
+batch_writers = {}
+batch_writers_lock = threading.Lock()
+
+# Existing records resolved by BatchGetItem for the current prefetch window per table, keyed on key values.
+# A value of None means the record was looked up and doesn't exist yet.
+prefetched_records = {
+    MOVIE_TABLE: {},
+    TV_SHOW_TABLE: {},
+    EPISODE_TABLE: {}
+}
+
+# Index of existing records per table built by the startup Scan, key values -> preserved field values in
+# PRESERVED_FIELDS order. Tables without an index aren't in the dict.
+existing_key_indexes = {}
+
+# Stands in for a preserved field the existing record doesn't have in existing_key_indexes
+MISSING_ATTRIBUTE = object()
+
+# [fingerprint of the feed fields, epoch seconds the record was last seen in the table] per record key, loaded from
+# FINGERPRINT_STATE_KEY at the start of the import. An empty fingerprint means the record is known to exist but wasn't
+# written from the current feed data.
+record_fingerprints = {}
+
+# Fingerprint keys added, changed or removed in the current invocation
+changed_fingerprint_keys = set()
+
+# Fingerprint hits and misses per table in the current invocation
+fingerprint_counts = {}
+
+# Number of records per outcome (inserted, updated, already present, failed) for each table in the current invocation
+record_counts = {}
+record_counts_lock = threading.Lock()
+
+# Set when any record failed in the current invocation, the feed then isn't recorded as imported
+# so the next run goes through the same records again
+import_failures = threading.Event()
+
+# TableWorkerPool per table name (and one for the TV Shows section) for the current invocation,
+# drained at the end of every prefetch window
+worker_pools = {}
+worker_pools_lock = threading.Lock()
+
+# LookupCache of the current invocation
+lookup_cache = None
+
+# CapacityRateLimiter per (table name, 'read' or 'write') for the current invocation
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# KeyFilter per table name loaded for the current invocation
+key_filters = {}
+
+# ImportCheckpoint of the current invocation
+import_checkpoint = None
+
+# Set when the current invocation is forced, which also imports records whose fingerprint matches or that are known to exist
+forced_import = False
+
+# ImportMetrics of the current invocation
+import_metrics = None
+
+# CapacityUsage of the current invocation
+capacity_usage = None
+
+# WarmKeyCache kept between invocations of a warm container
+warm_key_cache = None
+
+# LocalMirror kept between invocations of a warm container, opened by the first invocation using it
+local_mirror = None
+
+# ETag of the last feed imported successfully, kept between invocations of a warm container
+# so the state object only has to be read on a cold start
+last_imported_etag = None
+
+# Set once TABLE_KEYS was checked against the tables, kept between invocations of a warm container
+table_keys_verified = False
+
+# Functions importing each section of the feed
+SECTION_IMPORTERS = {
+    'Movies': lambda records: create_and_update_movies(records),
+    'TV Shows': lambda records: create_and_update_tv_shows(records)
+}
 
 
 def lambda_handler(event, context):
+    global capacity_usage, import_checkpoint, import_metrics, lookup_cache, warm_key_cache
+
     print("Import started.")
 
+    batch_writers.clear()
+    clear_prefetched_records(MOVIE_TABLE, TV_SHOW_TABLE, EPISODE_TABLE)
+    existing_key_indexes.clear()
+    key_filters.clear()
+    rate_limiters.clear()
+    record_counts.clear()
+    fingerprint_counts.clear()
+    import_failures.clear()
+    import_checkpoint = ImportCheckpoint(context)
+    import_metrics = ImportMetrics()
+    capacity_usage = CapacityUsage()
+    lookup_cache = LookupCache(LOOKUP_CACHE_SIZE)
+    if warm_key_cache is None:
+        warm_key_cache = WarmKeyCache(WARM_KEY_CACHE_MAX_KEYS)
+
+    event = event or {}
+    try:
+        result = import_feed(event, context)
+    except Exception as ex:
+        # A worker of the 'lambda' dispatcher was invoked asynchronously, its coordinator only learns from the result
+        if not event.get('resultKey'):
+            raise
+        print(f"Error importing shard. Exception: {ex}")
+        result = {'status': 'failed', 'error': str(ex)}
+    finally:
+        shutdown_worker_pools()
+
+    if event.get('resultKey'):
+        save_state_object(event['resultKey'], result)
+
+    print_record_counts()
+    print_fingerprint_counts()
+    lookup_cache.print_stats()
+    warm_key_cache.print_stats()
+    if TRACK_CONSUMED_CAPACITY:
+        capacity_usage.print_report()
+    if EMIT_IMPORT_METRICS:
+        import_metrics.emit(result['status'])
+
+    if result['status'] == 'checkpointed':
+        print("Import stopped before the timeout, it continues from the checkpoint.")
+    else:
+        print("Import completed.")
+    return result
+
+
+def verify_table_keys():
+    # Lookups, conditional writes and batches are all built from TABLE_KEYS, with a different key schema they would
+    # look up or overwrite the wrong records, so nothing is imported until it's fixed
+    for table_name, key_names in TABLE_KEYS.items():
+        key_schema = describe_table(table_name)['KeySchema']
+        # The partition key comes first, then the sort key
+        table_key_names = tuple(key['AttributeName'] for key in sorted(key_schema, key = lambda key: key['KeyType'] != 'HASH'))
+        if table_key_names != tuple(key_names):
+            raise Exception(f"Key schema of table {table_name} is {table_key_names}, TABLE_KEYS expects {tuple(key_names)}")
+
+
+def describe_table(table_name):
+    # boto3 may not retry on its own when RATE_LIMIT_REQUESTS is True, transient errors are retried here
+    attempt = 0
+    while True:
+        try:
+            return dynamodb.meta.client.describe_table(TableName = table_name)['Table']
+        except (ClientError, BotocoreConnectionError, HTTPClientError) as ex:
+            if isinstance(ex, ClientError) and ex.response['Error']['Code'] not in ('InternalServerError', 'ServiceUnavailable', 'ThrottlingException', 'LimitExceededException'):
+                raise
+            attempt += 1
+            if attempt > RATE_LIMIT_MAX_RETRIES:
+                raise
+            backoff_sleep(attempt)
+
+
+def import_feed(event, context):
+    global forced_import, last_imported_etag, table_keys_verified
+
     bucket = S3_BUCKET
     key = JSON_FILE
 
-    response = s3.get_object(Bucket = bucket, Key = key)
+    # Set when this invocation is a worker importing one shard of the feed for a coordinator
+    shard = event.get('shard')
+    forced_import = bool(FORCE_IMPORT or event.get('force'))
+
+    get_object_arguments = {}
+    if shard:
+        # Every shard has to come from the same feed the coordinator split, only its own records are downloaded
+        get_object_arguments['IfMatch'] = shard['etag']
+        get_object_arguments['Range'] = f"bytes={shard['bytes'][0]}-{shard['bytes'][1] - 1}"
+    elif SKIP_UNCHANGED_FEED and not forced_import:
+        if last_imported_etag is None:
+            import_state = load_state_object(IMPORT_STATE_KEY) or {}
+            last_imported_etag = import_state.get('etag')
+        if last_imported_etag:
+            get_object_arguments['IfNoneMatch'] = last_imported_etag
+
+    try:
+        with import_metrics.span('S3Download'):
+            response = s3.get_object(Bucket = bucket, Key = key, **get_object_arguments)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ('304', 'NotModified'):
+            print(f"Feed unchanged since the last import (ETag {last_imported_etag}), nothing to import.")
+            return {'status': 'unchanged'}
+        raise
+
     content = response['Body']
-    jsonObject = json.loads(content.read())
+    warm_key_cache.use_feed(response['ETag'])
 
-    create_and_update_movies(jsonObject['Movies'])
-    create_and_update_tv_shows(jsonObject['TV Shows'])
+    # Only once there's something to import, an unchanged feed doesn't touch DynamoDb
+    if not table_keys_verified:
+        verify_table_keys()
+        table_keys_verified = True
 
-    print("Import completed.")
-    
+    if CHECKPOINT_BEFORE_TIMEOUT:
+        # A cursor only applies to the feed it was taken on, a new feed starts from the beginning.
+        # The cursor of a shard is only ever passed in by the coordinator.
+        cursor = event.get('continuation') or (None if shard else load_state_object(CHECKPOINT_STATE_KEY))
+        if cursor and cursor['etag'] == response['ETag']:
+            import_checkpoint.resume_from(cursor)
+            print(f"Resuming import from checkpoint: {cursor['positions']}")
+    work_directory = None
 
-def create_and_update_movies(movie_json_data):
-    print("Movie import started.")
+    if SKIP_UNCHANGED_RECORDS:
+        record_fingerprints.clear()
+        record_fingerprints.update(load_state_object(FINGERPRINT_STATE_KEY) or {})
+        changed_fingerprint_keys.clear()
 
-    for movie in movie_json_data:
+    # A fanned out import looks records up as it goes, a Scan per shard would read the whole tables once per shard
+    if (SCAN_EXISTING_KEYS_AT_STARTUP or USE_LOCAL_MIRROR) and not (FAN_OUT_IMPORT or shard):
+        for table_name, update_existing_data in [(MOVIE_TABLE, UPDATE_EXISTING_MOVIE_DATA), (TV_SHOW_TABLE, UPDATE_EXISTING_TV_DATA), (EPISODE_TABLE, UPDATE_EXISTING_EPISODE_DATA)]:
+            if uses_lookup(update_existing_data):
+                if USE_LOCAL_MIRROR:
+                    load_local_mirror(table_name)
+                else:
+                    load_existing_key_index(table_name)
 
-        # Trim last three digits to only show milliseconds
-        current_date_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S %f')[:-3]
+    if USE_KEY_FILTERS and not (FAN_OUT_IMPORT or shard):
+        for table_name, update_existing_data in [(MOVIE_TABLE, UPDATE_EXISTING_MOVIE_DATA), (TV_SHOW_TABLE, UPDATE_EXISTING_TV_DATA), (EPISODE_TABLE, UPDATE_EXISTING_EPISODE_DATA)]:
+            if uses_lookup(update_existing_data) and table_name not in existing_key_indexes:
+                load_key_filter(table_name)
 
-        if len(get_dynamo_record_by_pk_and_field_value('name', movie['title'], 'year', movie['releaseDate'], movie_table)['Items']) > 0:
-            existing_movies = get_dynamo_record_by_pk_and_field_value('name', movie['title'], 'year', movie['releaseDate'], movie_table)['Items']
+    try:
+        if shard:
+            sections = [(shard['section'], JsonFeedStream(content).iter_records())]
+        elif FAN_OUT_IMPORT:
+            # The coordinator doesn't write anything itself, the workers' counts and fingerprints are merged into its own
+            import_shards(load_fan_out_state(content, response['ETag']), context)
+            sections = []
+        elif IMPORT_CHANGED_RECORDS_ONLY:
+            work_directory = tempfile.mkdtemp(prefix = 'feed-diff-', dir = DIFF_WORK_DIRECTORY)
+            with import_metrics.span('FeedDiff'):
+                sections, feed_digest_path = diff_feed(content, work_directory)
+        elif STREAM_JSON_FEED and CONCURRENT_SECTIONS:
+            # Every section after the first one is read from a download of its own, see FeedSectionStream
+            sections = [(section_name, FeedSectionStream(section_name, response['ETag'], content if index == 0 else None))
+                        for index, section_name in enumerate(SECTION_IMPORTERS)]
+        elif STREAM_JSON_FEED:
+            sections = iter_feed_sections(content)
         else:
-            existing_movies = None
+            with import_metrics.span('S3Download'):
+                feed_bytes = content.read()
+            with import_metrics.span('JsonParse'):
+                jsonObject = json.loads(feed_bytes)
+            sections = [('Movies', jsonObject['Movies']), ('TV Shows', jsonObject['TV Shows'])]
 
-        try:
-            if not existing_movies:
-                movie_table.put_item(Item = {
-                    'name': movie['title'], 
-                    'year': movie['releaseDate'], 
-                    'description': movie['longDescription'],
-                    'thumbnailUrl': movie['thumbnail'], 
-                    'rating': movie['rating'], 
-                    'cast': movie['cast'], 
-                    'director': movie['director'], 
-                    'genres': movie['genres'], 
-                    'duration': movie['content']['duration'], 
-                    'videoType': movie['content']['videos'][0]['videoType'], 
-                    'videoUrl': movie['content']['videos'][0]['url'], 
-                    'trailerUrl': None,
-                    'dateAdded': current_date_time, 
-                    'lastWatched': None,
-                    'views': 0
-                    })
-                print(f"Added new Movie: {movie['title']} ({movie['releaseDate']})")
-            elif UPDATE_EXISTING_MOVIE_DATA:
-                # If movie(s) already exists should update all fields in dynamo except dateAdded, lastWatched, and views
-                for existing_movie in existing_movies:
-                    movie_table.put_item(Item = {
-                        'name': movie['title'], 
-                        'year': movie['releaseDate'], 
-                        'description': movie['longDescription'],
-                        'thumbnailUrl': movie['thumbnail'], 
-                        'rating': movie['rating'], 
-                        'cast': movie['cast'], 
-                        'director': movie['director'], 
-                        'genres': movie['genres'], 
-                        'duration': movie['content']['duration'], 
-                        'videoType': movie['content']['videos'][0]['videoType'], 
-                        'videoUrl': movie['content']['videos'][0]['url'], 
-                        'trailerUrl': existing_movie['trailerUrl'],
-                        'dateAdded': existing_movie['dateAdded'],
-                        'lastWatched': existing_movie['lastWatched'],
-                        'views': existing_movie['views']
-                        })
-        except Exception as ex:
-                print(f"Error creating/updating Movie: {movie['title']} ({movie['releaseDate']}). Exception: {ex}")
-                print(ex)
-                
-    print("Movie import completed.")            
+        import_sections(sections)
 
+        # Every write the mirror was updated with went through, otherwise the next invocation builds it again
+        if local_mirror is not None and not import_failures.is_set():
+            local_mirror.mark_consistent()
 
-def create_and_update_tv_shows(tv_shows_json_data):
-    print("TV Show import started.")   
+        if shard:
+            # The coordinator saves the state for the whole feed once every shard is done
+            return get_shard_result(response['ETag'])
 
-    for tv_show in tv_shows_json_data:
+        # Only saved once the records went through, a failed run leaves the previous fingerprints in place
+        if SKIP_UNCHANGED_RECORDS and changed_fingerprint_keys:
+            save_state_object(FINGERPRINT_STATE_KEY, record_fingerprints)
 
-        # Trim last three digits to only show milliseconds
-        current_date_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S %f')[:-3]
+        save_key_filters()
 
-        if len(get_dynamo_record_by_pk('name', tv_show['title'], tv_show_table)['Items']) == 1:
-            existingTvShow = get_dynamo_record_by_pk('name', tv_show['title'], tv_show_table)['Items'][0]
-        else:
-            existingTvShow = None
-
-        if not existingTvShow:
-            tv_show_table.put_item(Item = {
-                'name': tv_show['title'], 
-                'description': tv_show['shortDescription'],
-                'thumbnailUrl': tv_show['thumbnail'],
-                'releaseDate': tv_show['releaseDate'],
-                "firstAired": tv_show["releaseDate"][:4],
-                'rating': tv_show['rating'],
-                'cast': tv_show['cast'],
-                'director': tv_show['director'],
-                'genres': tv_show['genres'],
-                'numberOfSeasons': len(tv_show['seasons']),
-                'dateAdded': current_date_time, 
-                'lastWatched': None,
-                'views': 0
-                })
-            print(f"Added new TV Show: {tv_show['title']}")
-        elif UPDATE_EXISTING_TV_DATA:
-            # If tv show already exists should update all fields in dynamo except dateAdded, lastWatched, and views
-            tv_show_table.put_item(Item = {
-                'name': tv_show['title'], 
-                'description': tv_show['shortDescription'], 
-                'thumbnailUrl': tv_show['thumbnail'],
-                'releaseDate': tv_show['releaseDate'],
-                "firstAired": tv_show["releaseDate"][:4],
-                'rating': tv_show['rating'],
-                'cast': tv_show['cast'],
-                'director': tv_show['director'],
-                'genres': tv_show['genres'],
-                'numberOfSeasons': len(tv_show['seasons']),
-                'dateAdded': existingTvShow['dateAdded'],
-                'lastWatched': existingTvShow['lastWatched'],
-                'views': existingTvShow['views']
+        if import_checkpoint.stopped.is_set():
+            cursor = import_checkpoint.get_cursor(response['ETag'])
+            save_state_object(CHECKPOINT_STATE_KEY, cursor)
+            if CONTINUE_IN_NEW_INVOCATION and context is not None:
+                lambda_client.invoke(FunctionName = context.invoked_function_arn, InvocationType = 'Event', Payload = json.dumps({'continuation': cursor, 'force': forced_import}))
+            return {'status': 'checkpointed', 'continuation': cursor}
+
+        if import_checkpoint.resumed:
+            s3.delete_object(Bucket = S3_BUCKET, Key = CHECKPOINT_STATE_KEY)
+
+        if import_failures.is_set() or import_checkpoint.earlier_failures:
+            print("Some records failed to import, the feed will be processed again on the next run.")
+            return {'status': 'completed with failures'}
+
+        if IMPORT_CHANGED_RECORDS_ONLY:
+            s3.upload_file(feed_digest_path, S3_BUCKET, FEED_DIGEST_KEY)
+
+        if SKIP_UNCHANGED_FEED:
+            save_state_object(IMPORT_STATE_KEY, {
+                'etag': response['ETag'],
+                'versionId': response.get('VersionId'),
+                'importedAt': datetime.today().strftime('%Y-%m-%d %H:%M:%S')
                 })
-        
-        for season in tv_show['seasons']:
-            for episode in season['episodes']:
-                
-                if notSpecialSeason(season['title']):
-                    season_number_padded = f"{int(season['title']):02}"  # e.g., '1' -> '01'
-                    episode_number_padded = f"{int(episode['episodeNumber']):02}"  # e.g., 3 -> '03'
-                    season_and_episode = f"S{season_number_padded} E{episode_number_padded}"
-                else:
-                    episode_number_padded = str(f"{int(episode['episodeNumber']):02}")
-                    season_and_episode = f"{season['title']} E{episode_number_padded}"
-                
-                if len(get_dynamo_record_by_pk_and_sk('tvShowName', tv_show['title'], 'seasonAndEpisode', season_and_episode, episode_table)['Items']) == 1:
-                    existing_episode = get_dynamo_record_by_pk_and_sk('tvShowName', tv_show['title'], 'seasonAndEpisode', season_and_episode, episode_table)['Items'][0]
-                else:
-                    existing_episode = None
-                
-                try:
-                    if not existing_episode:
-                        episode_table.put_item(Item = {
-                        'tvShowName': tv_show['title'], 
-                        'seasonAndEpisode': season_and_episode,
-                        'season': season['title'],
-                        'episode': episode['episodeNumber'],
-                        'name': episode['title'],
-                        'description': episode['longDescription'],
-                        'thumbnailUrl': episode['thumbnail'],
-                        'releaseDate': episode['releaseDate'],
-                        'rating': episode['rating'],
-                        'cast': episode['cast'],
-                        'director': episode['director'],
-                        'genres': episode['genres'],
-                        'videoType': episode['content']['videos'][0]['videoType'],
-                        'videoUrl': episode['content']['videos'][0]['url'],
-                        'duration': episode['content']['duration'],
-                        'dateAdded': current_date_time, 
-                        'lastWatched': None,
-                        'views': 0
-                        })
-                    elif UPDATE_EXISTING_EPISODE_DATA:
-                        # If episode already exists should update all fields in dynamo except dateAdded, lastWatched, and views
-                        episode_table.put_item(Item = {
-                        'tvShowName': tv_show['title'], 
-                        'seasonAndEpisode': season_and_episode,
-                        'season': season['title'],
-                        'episode': episode['episodeNumber'],
-                        'name': episode['title'],
-                        'description': episode['longDescription'],
-                        'thumbnailUrl': episode['thumbnail'],
-                        'releaseDate': episode['releaseDate'],
-                        'rating': episode['rating'],
-                        'cast': episode['cast'],
-                        'director': episode['director'],
-                        'genres': episode['genres'],
-                        'videoType': episode['content']['videos'][0]['videoType'],
-                        'videoUrl': episode['content']['videos'][0]['url'],
-                        'duration': episode['content']['duration'],
-                        'dateAdded': existing_episode['dateAdded'], 
-                        'lastWatched': existing_episode['lastWatched'],
-                        'views': existing_episode['views']
-                        })
+            last_imported_etag = response['ETag']
+    finally:
+        if work_directory:
+            shutil.rmtree(work_directory, ignore_errors = True)
+
+    return {'status': 'completed'}
+
+
+def load_fan_out_state(content, etag):
+    # Returns the shards and merged results saved by a coordinator that stopped on the same feed, or splits the feed
+    fan_out_state = load_state_object(FAN_OUT_STATE_KEY)
+
+    if fan_out_state and fan_out_state['etag'] == etag:
+        print(f"Resuming fan out with {len(fan_out_state['shards'])} shards left.")
+        merge_shard_result({**fan_out_state['merged'], 'fingerprints': {}})
+        fan_out_state['resumed'] = True
+        return fan_out_state
+
+    shards = [{'shard': shard, 'continuation': None, 'resultKey': None, 'dispatchedAt': None} for shard in get_shards(content, etag)]
+    return {'etag': etag, 'shards': shards, 'resumed': False}
+
+
+def get_shards(content, etag):
+    # Reads through the feed once to count the records of each section and splits them into index ranges, with the
+    # byte range of the feed holding each one. Always streamed, the byte offsets come from the stream.
+    feed_stream = JsonFeedStream(content)
 
+    shards = []
+    for section_name, records in feed_stream.iter_sections():
+        if section_name not in SECTION_IMPORTERS:
+            continue
+
+        shard_size = FAN_OUT_SHARD_SIZES[section_name]
+        shard_start = 0
+        start_offset = feed_stream.get_byte_offset()
+        record_count = 0
+
+        for _ in records:
+            record_count += 1
+            if record_count - shard_start == shard_size:
+                end_offset = feed_stream.get_byte_offset()
+                shards.append({'section': section_name, 'start': shard_start, 'stop': record_count, 'bytes': [start_offset, end_offset], 'etag': etag})
+                shard_start = record_count
+                start_offset = end_offset
+
+        # The last range also holds the closing ']' of the section, which ends the records of the shard
+        if record_count > shard_start:
+            shards.append({'section': section_name, 'start': shard_start, 'stop': record_count, 'bytes': [start_offset, feed_stream.get_byte_offset()], 'etag': etag})
+
+    print(f"Feed split into {len(shards)} shards.")
+    return shards
+
+
+def import_shards(fan_out_state, context):
+    # Runs the shards of fan_out_state still to do and merges their results. Saves what's left in FAN_OUT_STATE_KEY
+    # when the coordinator runs out of time, the shards still running save their result in S3 for the next one.
+    shards = fan_out_state['shards']
+
+    if FAN_OUT_DISPATCHER == 'process':
+        import_shards_in_processes(shards)
+    else:
+        import_shards_in_lambdas(shards, FAN_OUT_FUNCTION_NAME or context.invoked_function_arn)
+
+    if import_checkpoint.stopped.is_set():
+        fan_out_state['merged'] = {'recordCounts': record_counts, 'fingerprintCounts': fingerprint_counts, 'consumedCapacity': capacity_usage.units}
+        save_state_object(FAN_OUT_STATE_KEY, {key: value for key, value in fan_out_state.items() if key != 'resumed'})
+        print(f"Fan out stopped with {len(shards)} shards left.")
+    elif fan_out_state['resumed']:
+        s3.delete_object(Bucket = S3_BUCKET, Key = FAN_OUT_STATE_KEY)
+
+
+def import_shards_in_lambdas(shards, function_name):
+    # Workers are invoked asynchronously and save their result in S3, which is checked every FAN_OUT_POLL_SECONDS.
+    # Shards are removed from the list once they are done.
+    while shards:
+        for entry in [entry for entry in shards if entry['resultKey']]:
+            if collect_shard_result(entry):
+                shards.remove(entry)
+
+        if import_checkpoint.out_of_time():
+            return
+
+        running = sum(1 for entry in shards if entry['resultKey'])
+        for entry in [entry for entry in shards if not entry['resultKey']][:FAN_OUT_WORKERS - running]:
+            entry['resultKey'] = FAN_OUT_RESULT_KEY_PREFIX + uuid.uuid4().hex + '.json'
+            entry['dispatchedAt'] = time.time()
+            lambda_client.invoke(FunctionName = function_name, InvocationType = 'Event', Payload = json.dumps({**get_shard_event(entry), 'resultKey': entry['resultKey']}))
+
+        if shards:
+            time.sleep(FAN_OUT_POLL_SECONDS)
+
+
+def collect_shard_result(entry):
+    # Returns True once the shard is done, False while it's still running or has to continue from a checkpoint
+    result = load_state_object(entry['resultKey'])
+
+    if result is None:
+        if time.time() - entry['dispatchedAt'] < FAN_OUT_SHARD_TIMEOUT_SECONDS:
+            return False
+        result = {'status': 'failed', 'error': f"no result after {FAN_OUT_SHARD_TIMEOUT_SECONDS} seconds"}
+    else:
+        s3.delete_object(Bucket = S3_BUCKET, Key = entry['resultKey'])
+
+    entry['resultKey'] = None
+    return handle_shard_result(entry, result)
+
+
+def import_shards_in_processes(shards):
+    with ProcessPoolExecutor(max_workers = FAN_OUT_WORKERS, mp_context = multiprocessing.get_context('fork'), initializer = create_clients) as executor:
+        pending = {executor.submit(import_shard, get_shard_event(entry)): entry for entry in shards}
+
+        while pending:
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                entry = pending.pop(future)
+
+                try:
+                    result = future.result()
                 except Exception as ex:
-                    print(f"Error creating/updating TV Show: {tv_show['title']}, Season/Episode: {season_and_episode}. Exception: {ex}")
+                    result = {'status': 'failed', 'error': str(ex)}
 
+                if handle_shard_result(entry, result):
+                    shards.remove(entry)
+                else:
+                    pending[executor.submit(import_shard, get_shard_event(entry))] = entry
 
-    print("TV Show import completed.")       
 
+def get_shard_event(entry):
+    return {'shard': entry['shard'], 'continuation': entry['continuation'], 'force': forced_import}
 
-def notSpecialSeason(season_name):
-    if season_name != 'Pilot' and season_name != 'Extras' and season_name != 'Movies' and season_name != 'Mini Series':
+
+def handle_shard_result(entry, result):
+    # Merges the result of a shard, returns False when the worker ran out of time and a new one has to carry on
+    shard = entry['shard']
+
+    if result['status'] == 'failed':
+        print(f"Error importing shard {shard['section']} {shard['start']}-{shard['stop']}. Exception: {result['error']}")
+        import_failures.set()
         return True
-    else:
+
+    merge_shard_result(result)
+
+    if result['status'] == 'checkpointed':
+        entry['continuation'] = result['continuation']
         return False
+    if result['status'] != 'completed':
+        import_failures.set()
+    return True
 
 
-def get_dynamo_record_by_pk(pk_name, pk_value, table):
-    try:
-        return table.query(KeyConditionExpression=Key(pk_name).eq(pk_value))
-    except Exception as ex:
-        print(f"Error retrieving records with primary key {pk_value} from table {table}. Exception: {ex}")
+def import_shard(shard_event):
+    # Runs in a process of the 'process' dispatcher, without a Lambda context the shard never checkpoints
+    return lambda_handler(shard_event, None)
 
 
-def get_dynamo_record_by_pk_and_sk(pk_name, pk_value, sk_name, sk_value, table):
+def get_shard_result(etag):
+    if import_checkpoint.stopped.is_set():
+        status = 'checkpointed'
+    elif import_failures.is_set() or import_checkpoint.earlier_failures:
+        status = 'completed with failures'
+    else:
+        status = 'completed'
+
+    return {
+        'status': status,
+        'continuation': import_checkpoint.get_cursor(etag) if status == 'checkpointed' else None,
+        'recordCounts': record_counts,
+        'fingerprintCounts': fingerprint_counts,
+        'consumedCapacity': capacity_usage.units,
+        # None stands for a fingerprint that was removed
+        'fingerprints': {fingerprint_key: record_fingerprints.get(fingerprint_key) for fingerprint_key in changed_fingerprint_keys}
+        }
+
+
+def merge_shard_result(result):
+    with record_counts_lock:
+        for counts, shard_counts in [(record_counts, result['recordCounts']), (fingerprint_counts, result['fingerprintCounts'])]:
+            for table_name, table_counts in shard_counts.items():
+                counts.setdefault(table_name, {})
+                for outcome, count in table_counts.items():
+                    counts[table_name][outcome] = counts[table_name].get(outcome, 0) + count
+
+    capacity_usage.merge(result['consumedCapacity'])
+
+    for fingerprint_key, fingerprint in result['fingerprints'].items():
+        if fingerprint is None:
+            record_fingerprints.pop(fingerprint_key, None)
+        else:
+            record_fingerprints[fingerprint_key] = fingerprint
+        changed_fingerprint_keys.add(fingerprint_key)
+
+
+def import_sections(sections):
+    if CONCURRENT_SECTIONS:
+        import_sections_concurrently(sections)
+    else:
+        # When streaming each section is consumed by its create/update function before the stream moves on to the next one
+        for section_name, records in sections:
+            if import_checkpoint.stopped.is_set():
+                break
+            if section_name in SECTION_IMPORTERS:
+                SECTION_IMPORTERS[section_name](records)
+
+
+def import_sections_concurrently(sections):
+    # The feed is read on this thread and handed to one importer thread per section through a queue, unless each
+    # section can be read on its own
+    end_of_section = object()
+
+    with ThreadPoolExecutor(max_workers = len(SECTION_IMPORTERS), thread_name_prefix = 'section') as executor:
+        futures = []
+
+        for section_name, records in sections:
+            if section_name not in SECTION_IMPORTERS:
+                continue
+
+            if isinstance(records, (list, FeedSectionStream)):
+                futures.append(executor.submit(SECTION_IMPORTERS[section_name], records))
+                continue
+
+            section_queue = queue.Queue(maxsize = SECTION_BUFFER_SIZE)
+            future = executor.submit(SECTION_IMPORTERS[section_name], iter(section_queue.get, end_of_section))
+            futures.append(future)
+
+            for record in itertools.chain(records, [end_of_section]):
+                # Once the importers checkpointed nothing more is read, the end marker goes through in place of the record
+                if import_checkpoint.stopped.is_set():
+                    record = end_of_section
+                while not future.done():
+                    try:
+                        section_queue.put(record, timeout = 1)
+                        break
+                    except queue.Full:
+                        pass
+
+                # Stop reading if the importer died, otherwise this would wait on a full queue forever
+                if future.done():
+                    future.result()
+                    break
+                if record is end_of_section:
+                    break
+
+            # The sections left are imported after the checkpoint, reading on would only decode them
+            if import_checkpoint.stopped.is_set():
+                break
+
+        for future in futures:
+            future.result()
+
+
+def create_and_update_movies(movie_json_data):
+    print("Movie import started.")
+
+    if import_checkpoint.is_section_completed('Movies'):
+        print("Movies were already imported before the checkpoint.")
+        return
+
+    # Resumes after the last movie processed before the checkpoint
+    movie_index = import_checkpoint.get_position('Movies')[0]
+    movie_json_data = itertools.islice(movie_json_data, movie_index, None)
+
+    prefetch_movies = PREFETCH_EXISTING_RECORDS and uses_lookup(UPDATE_EXISTING_MOVIE_DATA) and MOVIE_TABLE not in existing_key_indexes
+
+    for movies in iter_prefetch_windows(movie_json_data, prefetch_movies):
+
+        if prefetch_movies:
+            prefetch_existing_records({MOVIE_TABLE: [
+                (movie['title'], movie['releaseDate']) for movie in movies
+                if not fingerprint_matches(MOVIE_TABLE, lambda: build_movie_item(movie, None), UPDATE_EXISTING_MOVIE_DATA)
+                ]})
+
+        for movie in movies:
+            if import_checkpoint.out_of_time():
+                break
+            submit_record(MOVIE_TABLE, create_and_update_movie, movie)
+            movie_index += 1
+
+        # Prefetched records are only dropped once every record of the window has been processed
+        if prefetch_movies:
+            drain_worker_pools(MOVIE_TABLE)
+            clear_prefetched_records(MOVIE_TABLE)
+
+        if import_checkpoint.stopped.is_set():
+            break
+
+    drain_worker_pools(MOVIE_TABLE)
+    flush_batch_writes(movie_table)
+
+    if import_checkpoint.stopped.is_set():
+        import_checkpoint.set_position('Movies', movie_index)
+    else:
+        import_checkpoint.complete_section('Movies')
+
+    print("Movie import completed.")            
+
+
+def create_and_update_movie(movie):
+
+    # Trim last three digits to only show milliseconds
+    current_date_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S %f')[:-3]
+
     try:
-        return table.query(KeyConditionExpression=Key(pk_name).eq(pk_value) & Key(sk_name).eq(sk_value))
+        new_movie = build_movie_item(movie, current_date_time)
+
+        if is_unchanged_record(MOVIE_TABLE, new_movie, UPDATE_EXISTING_MOVIE_DATA):
+            return
+
+        if is_insert_only(UPDATE_EXISTING_MOVIE_DATA):
+            if put_item_if_absent(movie_table, new_movie):
+                print(f"Added new Movie: {movie['title']} ({movie['releaseDate']})")
+            return
+
+        if is_upsert(UPDATE_EXISTING_MOVIE_DATA):
+            if upsert_item(movie_table, new_movie):
+                print(f"Added new Movie: {movie['title']} ({movie['releaseDate']})")
+            return
     except Exception as ex:
-        print(f"Error retrieving records with primary key {pk_value} and sort key {sk_value} from table {table}. Exception: {ex}")
+        count_record(MOVIE_TABLE, 'failed')
+        print(f"Error creating/updating Movie: {movie['title']} ({movie['releaseDate']}). Exception: {ex}")
+        return
 
+    existing_movies = find_existing_movies(movie)
 
-def get_dynamo_record_by_pk_and_field_value(pk_name, pk_value, field_name, field_value, table):
     try:
-        return table.query(KeyConditionExpression=Key(pk_name).eq(pk_value), FilterExpression=Attr(field_name).eq(field_value))
+        if not existing_movies:
+            write_item(movie_table, new_movie, message = f"Added new Movie: {movie['title']} ({movie['releaseDate']})")
+        elif UPDATE_EXISTING_MOVIE_DATA:
+            # If movie(s) already exists should update all fields in dynamo except dateAdded, lastWatched, and views
+            for existing_movie in existing_movies:
+                write_item(movie_table, build_movie_item(movie, existing_movie['dateAdded'], existing_movie['lastWatched'], existing_movie['views'], existing_movie['trailerUrl']), 'update')
+        else:
+            count_record(MOVIE_TABLE, 'already present', new_movie)
     except Exception as ex:
-        print(f"Error retrieving records with primary key {pk_value} and {field_name} {field_value} from table {table}. Exception: {ex}")
+            count_record(MOVIE_TABLE, 'failed')
+            print(f"Error creating/updating Movie: {movie['title']} ({movie['releaseDate']}). Exception: {ex}")
+            print(ex)
+
+
+def create_and_update_tv_shows(tv_shows_json_data):
+    print("TV Show import started.")   
+
+    if import_checkpoint.is_section_completed('TV Shows'):
+        print("TV Shows were already imported before the checkpoint.")
+        return
+
+    # Resumes at the season and episode of the show that was being processed when the checkpoint was taken
+    tv_show_index, resume_season_index, resume_episode_index = import_checkpoint.get_position('TV Shows')
+    resume_tv_show_index = tv_show_index
+    stopped_at = None
+    tv_shows_json_data = itertools.islice(tv_shows_json_data, tv_show_index, None)
+
+    prefetch_tv_shows = PREFETCH_EXISTING_RECORDS and uses_lookup(UPDATE_EXISTING_TV_DATA) and TV_SHOW_TABLE not in existing_key_indexes
+    prefetch_episodes = PREFETCH_EXISTING_RECORDS and uses_lookup(UPDATE_EXISTING_EPISODE_DATA) and not LOAD_EPISODE_INDEX_PER_SHOW and EPISODE_TABLE not in existing_key_indexes
+
+    for tv_shows in iter_prefetch_windows(tv_shows_json_data, prefetch_tv_shows or prefetch_episodes):
+
+        if prefetch_tv_shows or prefetch_episodes:
+            keys_by_table = {}
+            if prefetch_tv_shows:
+                keys_by_table[TV_SHOW_TABLE] = [
+                    (tv_show['title'],) for tv_show in tv_shows
+                    if not fingerprint_matches(TV_SHOW_TABLE, lambda: build_tv_show_item(tv_show, None), UPDATE_EXISTING_TV_DATA)
+                    ]
+            if prefetch_episodes:
+                keys_by_table[EPISODE_TABLE] = [
+                    (tv_show['title'], get_season_and_episode(season, episode)) for tv_show in tv_shows for season in tv_show['seasons'] for episode in season['episodes']
+                    if not fingerprint_matches(EPISODE_TABLE, lambda: build_episode_item(tv_show, season, episode, get_season_and_episode(season, episode), None), UPDATE_EXISTING_EPISODE_DATA)
+                    ]
+            prefetch_existing_records(keys_by_table)
+
+        if SCHEDULE_EPISODE_WRITES:
+            # Shows the scheduler started always finish, the checkpoint is taken between shows
+            resume_at = None
+            if tv_show_index == resume_tv_show_index and (resume_season_index or resume_episode_index):
+                resume_at = (resume_season_index, resume_episode_index)
+
+            tv_shows_started, ran_out_of_time = EpisodeWriteScheduler().run(tv_shows, resume_at)
+            tv_show_index += tv_shows_started
+            if ran_out_of_time:
+                stopped_at = [tv_show_index, 0, 0]
+        else:
+            for tv_show in tv_shows:
+                if import_checkpoint.out_of_time():
+                    stopped_at = [tv_show_index, 0, 0]
+                    break
+
+                resume_at = None
+                if tv_show_index == resume_tv_show_index and (resume_season_index or resume_episode_index):
+                    resume_at = (resume_season_index, resume_episode_index)
+
+                if CONCURRENT_SECTIONS:
+                    # Shows running in parallel always finish, the checkpoint is taken between shows
+                    get_worker_pool('TV Shows', TV_SHOW_SECTION_WORKERS).submit(create_and_update_tv_show, tv_show, resume_at)
+                else:
+                    show_stopped_at = create_and_update_tv_show(tv_show, resume_at, can_stop = True)
+                    if show_stopped_at:
+                        stopped_at = [tv_show_index] + show_stopped_at
+                        break
+                tv_show_index += 1
+
+        # Shows first since they are still submitting episodes
+        if prefetch_tv_shows or prefetch_episodes:
+            drain_worker_pools('TV Shows', TV_SHOW_TABLE, EPISODE_TABLE)
+            clear_prefetched_records(TV_SHOW_TABLE, EPISODE_TABLE)
+
+        if stopped_at:
+            break
+
+    drain_worker_pools('TV Shows', TV_SHOW_TABLE, EPISODE_TABLE)
+    flush_batch_writes(tv_show_table, episode_table)
+
+    if stopped_at:
+        import_checkpoint.set_position('TV Shows', *stopped_at)
+    else:
+        import_checkpoint.complete_section('TV Shows')
+
+    print("TV Show import completed.")       
+
+
+def create_and_update_tv_show(tv_show, resume_at = None, can_stop = False):
+    # resume_at is the (season position, episode position) to start from when the show was cut off by a checkpoint,
+    # when can_stop is set the show itself checkpoints between episodes and returns [season position, episode position]
+
+    current_date_time, episode_index = prepare_tv_show(tv_show, resume_at)
+
+    for season_position, episode_position, season, episode in iter_tv_show_episodes(tv_show, resume_at):
+        if can_stop and import_checkpoint.out_of_time():
+            return [season_position, episode_position]
+        submit_record(EPISODE_TABLE, create_and_update_episode, tv_show, season, episode, current_date_time, episode_index)
+
+    return None
+
+
+def prepare_tv_show(tv_show, resume_at = None):
+    # Submits the show's own record and loads its existing episodes, returns what its episodes are processed with
+
+    # Trim last three digits to only show milliseconds
+    current_date_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S %f')[:-3]
+
+    if resume_at is None:
+        submit_record(TV_SHOW_TABLE, create_and_update_tv_show_record, tv_show, current_date_time)
+
+    episode_index = None
+    if LOAD_EPISODE_INDEX_PER_SHOW and uses_lookup(UPDATE_EXISTING_EPISODE_DATA) and EPISODE_TABLE not in existing_key_indexes:
+        # Not needed when every episode of the show is going to be skipped as unchanged or definitely doesn't exist
+        if not all(
+            fingerprint_matches(EPISODE_TABLE, lambda: build_episode_item(tv_show, season, episode, get_season_and_episode(season, episode), None), UPDATE_EXISTING_EPISODE_DATA)
+            or is_definitely_absent(EPISODE_TABLE, (tv_show['title'], get_season_and_episode(season, episode)))
+            for season in tv_show['seasons'] for episode in season['episodes']
+            ):
+            episode_index = load_episode_index(tv_show['title'])
+
+    return current_date_time, episode_index
+
+
+def iter_tv_show_episodes(tv_show, resume_at = None):
+    for season_position, season in enumerate(tv_show['seasons']):
+        for episode_position, episode in enumerate(season['episodes']):
+            if resume_at and (season_position, episode_position) < resume_at:
+                continue
+            yield season_position, episode_position, season, episode
+
+
+class EpisodeWriteScheduler:
+    # Interleaves the episodes of up to EPISODE_SCHEDULER_SHOWS tv shows round-robin, every show being one partition
+    # key of the episodes table, and holds back a show while EPISODE_PARTITION_MAX_IN_FLIGHT of its episodes are still
+    # being processed. Shows are started in feed order and a started show is always finished.
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.in_flight = {}
+
+    def run(self, tv_shows, resume_at = None):
+        # Returns the number of tv shows started and whether the import ran out of time before starting all of them.
+        # Shows are only taken from tv_shows when they are started, resume_at applies to the first show.
+        tv_shows = iter(tv_shows)
+        active_shows = collections.deque()
+        tv_shows_started = 0
+        all_started = False
+
+        while True:
+            while len(active_shows) < EPISODE_SCHEDULER_SHOWS and not all_started and not import_checkpoint.out_of_time():
+                tv_show = next(tv_shows, None)
+                if tv_show is None:
+                    all_started = True
+                    break
+                active_shows.append(self._start_show(tv_show, resume_at if tv_shows_started == 0 else None))
+                tv_shows_started += 1
+
+            if not active_shows:
+                return tv_shows_started, not all_started
+
+            if not self._submit_round(active_shows):
+                # Every active show is at its limit or still loading its existing episodes
+                with self.condition:
+                    self.condition.wait(timeout = 0.05)
+
+    def _start_show(self, tv_show, resume_at):
+        if CONCURRENT_SECTIONS:
+            prepared = get_worker_pool('TV Shows', TV_SHOW_SECTION_WORKERS).submit(prepare_tv_show, tv_show, resume_at)
+        else:
+            prepared = Future()
+            prepared.set_result(prepare_tv_show(tv_show, resume_at))
+        return {'tv_show': tv_show, 'prepared': prepared, 'episodes': iter_tv_show_episodes(tv_show, resume_at)}
+
+    def _submit_round(self, active_shows):
+        # Submits at most one episode of every active show, returns False when none could be submitted
+        progressed = False
+
+        for _ in range(len(active_shows)):
+            show = active_shows.popleft()
+            tv_show = show['tv_show']
+
+            if not show['prepared'].done():
+                active_shows.append(show)
+                continue
+            if show['prepared'].exception() is not None:
+                # Already reported by the worker pool, the show's episodes are left out
+                progressed = True
+                continue
+
+            with self.condition:
+                if self.in_flight.get(tv_show['title'], 0) >= EPISODE_PARTITION_MAX_IN_FLIGHT:
+                    active_shows.append(show)
+                    continue
+
+            next_episode = next(show['episodes'], None)
+            progressed = True
+            if next_episode is None:
+                continue
+
+            with self.condition:
+                self.in_flight[tv_show['title']] = self.in_flight.get(tv_show['title'], 0) + 1
+
+            _, _, season, episode = next_episode
+            current_date_time, episode_index = show['prepared'].result()
+            submit_record(EPISODE_TABLE, self._create_and_update_episode, tv_show, season, episode, current_date_time, episode_index)
+            active_shows.append(show)
+
+        return progressed
+
+    def _create_and_update_episode(self, tv_show, *args):
+        try:
+            create_and_update_episode(tv_show, *args)
+        finally:
+            with self.condition:
+                self.in_flight[tv_show['title']] -= 1
+                self.condition.notify_all()
+
+
+def create_and_update_tv_show_record(tv_show, current_date_time):
+    try:
+        new_tv_show = build_tv_show_item(tv_show, current_date_time)
+
+        if is_unchanged_record(TV_SHOW_TABLE, new_tv_show, UPDATE_EXISTING_TV_DATA):
+            return
+
+        if is_insert_only(UPDATE_EXISTING_TV_DATA):
+            if put_item_if_absent(tv_show_table, new_tv_show):
+                print(f"Added new TV Show: {tv_show['title']}")
+        elif is_upsert(UPDATE_EXISTING_TV_DATA):
+            if upsert_item(tv_show_table, new_tv_show):
+                print(f"Added new TV Show: {tv_show['title']}")
+        else:
+            existingTvShow = find_existing_tv_show(tv_show)
+
+            if not existingTvShow:
+                write_item(tv_show_table, new_tv_show, message = f"Added new TV Show: {tv_show['title']}")
+            elif UPDATE_EXISTING_TV_DATA:
+                # If tv show already exists should update all fields in dynamo except dateAdded, lastWatched, and views
+                write_item(tv_show_table, build_tv_show_item(tv_show, existingTvShow['dateAdded'], existingTvShow['lastWatched'], existingTvShow['views']), 'update')
+            else:
+                count_record(TV_SHOW_TABLE, 'already present', new_tv_show)
+    except Exception as ex:
+        count_record(TV_SHOW_TABLE, 'failed')
+        print(f"Error creating/updating TV Show: {tv_show['title']}. Exception: {ex}")
+
+
+def create_and_update_episode(tv_show, season, episode, current_date_time, episode_index = None):
+    season_and_episode = get_season_and_episode(season, episode)
+
+    try:
+        new_episode = build_episode_item(tv_show, season, episode, season_and_episode, current_date_time)
+
+        if is_unchanged_record(EPISODE_TABLE, new_episode, UPDATE_EXISTING_EPISODE_DATA):
+            return
+
+        if is_insert_only(UPDATE_EXISTING_EPISODE_DATA):
+            put_item_if_absent(episode_table, new_episode)
+            return
+
+        if is_upsert(UPDATE_EXISTING_EPISODE_DATA):
+            upsert_item(episode_table, new_episode)
+            return
+
+        existing_episode = find_existing_episode(tv_show, season_and_episode, episode_index)
+
+        if not existing_episode:
+            write_item(episode_table, new_episode)
+        elif UPDATE_EXISTING_EPISODE_DATA:
+            # If episode already exists should update all fields in dynamo except dateAdded, lastWatched, and views
+            write_item(episode_table, build_episode_item(tv_show, season, episode, season_and_episode, existing_episode['dateAdded'], existing_episode['lastWatched'], existing_episode['views']), 'update')
+        else:
+            count_record(EPISODE_TABLE, 'already present', new_episode)
+
+    except Exception as ex:
+        count_record(EPISODE_TABLE, 'failed')
+        print(f"Error creating/updating TV Show: {tv_show['title']}, Season/Episode: {season_and_episode}. Exception: {ex}")
+
+
+def is_insert_only(update_existing_data):
+    return INSERT_ONLY_CONDITIONAL_PUTS and not update_existing_data
+
+
+def is_upsert(update_existing_data):
+    return UPSERT_WITH_UPDATE_ITEM and update_existing_data
+
+
+def uses_lookup(update_existing_data):
+    # Only the original read-before-write path needs existing records, insert-only and upsert writes are blind
+    return not is_insert_only(update_existing_data) and not is_upsert(update_existing_data)
+
+
+def put_item_if_absent(table, item):
+    # Insert-only write, the condition on the partition key makes DynamoDb reject the put when the record already exists
+    # so no read is needed beforehand. Returns False when the record was already present.
+    lookup_cache.invalidate(table.name, item)
+    try:
+        call_dynamodb(table.name, 'write', 1, table.put_item, phase = 'insert', Item = item, ConditionExpression = Attr(TABLE_KEYS[table.name][0]).not_exists())
+    except ClientError as ex:
+        if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        count_record(table.name, 'already present', item)
+        return False
+
+    count_record(table.name, 'inserted', item)
+    return True
+
+
+def upsert_item(table, item):
+    # Sets every feed field of the item and only fills in the preserved fields when the record doesn't have them yet,
+    # the values in the item for those fields are the defaults for a new record. Returns True when the record is new.
+    key_names = TABLE_KEYS[table.name]
+    preserved_fields = PRESERVED_FIELDS[table.name]
+    assignments = []
+    attribute_names = {}
+    attribute_values = {}
+
+    for index, (attribute_name, value) in enumerate(item.items()):
+        if attribute_name in key_names:
+            continue
+
+        attribute_names[f"#attr{index}"] = attribute_name
+        attribute_values[f":val{index}"] = value
+        if attribute_name in preserved_fields:
+            assignments.append(f"#attr{index} = if_not_exists(#attr{index}, :val{index})")
+        else:
+            assignments.append(f"#attr{index} = :val{index}")
+
+    lookup_cache.invalidate(table.name, item)
+
+    # UPDATED_OLD only returns attributes when the record existed before this update
+    response = call_dynamodb(table.name, 'write', 1, table.update_item,
+        phase = lambda response: 'update' if response.get('Attributes') else 'insert',
+        Key = {key_name: item[key_name] for key_name in key_names},
+        UpdateExpression = 'SET ' + ', '.join(assignments),
+        ExpressionAttributeNames = attribute_names,
+        ExpressionAttributeValues = attribute_values,
+        ReturnValues = 'UPDATED_OLD'
+        )
+
+    if response.get('Attributes'):
+        count_record(table.name, 'updated', item)
+        return False
+
+    count_record(table.name, 'inserted', item)
+    return True
+
+
+def count_record(table_name, outcome, item = None):
+    with record_counts_lock:
+        record_counts.setdefault(table_name, {})
+        record_counts[table_name][outcome] = record_counts[table_name].get(outcome, 0) + 1
+
+    if outcome == 'failed':
+        import_failures.set()
+
+    if item is not None and SKIP_UNCHANGED_RECORDS:
+        remember_fingerprint(table_name, item, outcome)
+
+    if item is not None and outcome in ('inserted', 'updated', 'already present'):
+        warm_key_cache.add(table_name, get_item_key(table_name, item))
+        if table_name in key_filters:
+            key_filters[table_name].add(get_item_key(table_name, item))
+
+
+def is_unchanged_record(table_name, item, update_existing_data):
+    # A record is unchanged when it was written with the same feed data before, or when only new records are being
+    # added and it's already known to exist. A forced import goes to DynamoDb for every record.
+    if forced_import:
+        return False
+
+    if SKIP_UNCHANGED_RECORDS:
+        unchanged = has_matching_fingerprint(table_name, item, update_existing_data)
+
+        with record_counts_lock:
+            fingerprint_counts.setdefault(table_name, {'hits': 0, 'misses': 0})
+            fingerprint_counts[table_name]['hits' if unchanged else 'misses'] += 1
+
+        if unchanged:
+            count_record(table_name, 'unchanged')
+            return True
+
+    if is_known_existing(table_name, item, update_existing_data):
+        # Counted without the item, seeing the record in the feed again doesn't confirm it still exists in the table
+        count_record(table_name, 'already present')
+        return True
+    return False
+
+
+def fingerprint_matches(table_name, build_item, update_existing_data):
+    # Same check as is_unchanged_record without counting it, used to leave unchanged records out of lookups.
+    # Takes a function building the item so a malformed record counts as changed here and is reported when processed.
+    if forced_import or (not SKIP_UNCHANGED_RECORDS and not WARM_KEY_CACHE):
+        return False
+
+    try:
+        item = build_item()
+    except Exception:
+        return False
+
+    return (SKIP_UNCHANGED_RECORDS and has_matching_fingerprint(table_name, item, update_existing_data)) or is_known_existing(table_name, item, update_existing_data, count_hit = False)
+
+
+def has_matching_fingerprint(table_name, item, update_existing_data):
+    # Only new records are added to a table without updates, so any recent fingerprint will do. Fingerprints from
+    # before they had a timestamp are plain strings and count as expired.
+    entry = record_fingerprints.get(get_fingerprint_key(table_name, item))
+    if not isinstance(entry, list) or time.time() - entry[1] > FINGERPRINT_MAX_AGE_SECONDS:
+        return False
+    return not update_existing_data or entry[0] == get_fingerprint(table_name, item)
+
+
+def is_known_existing(table_name, item, update_existing_data, count_hit = True):
+    # Existence is all that matters when only new records are added, updates need the existing record's preserved fields
+    return WARM_KEY_CACHE and not update_existing_data and warm_key_cache.contains(table_name, get_item_key(table_name, item), count_hit)
+
+
+def remember_fingerprint(table_name, item, outcome):
+    fingerprint_key = get_fingerprint_key(table_name, item)
+
+    entry = record_fingerprints.get(fingerprint_key)
+
+    if outcome in ('inserted', 'updated'):
+        fingerprint = get_fingerprint(table_name, item)
+    elif outcome == 'already present':
+        fingerprint = entry[0] if isinstance(entry, list) else ''
+    else:
+        return
+
+    # Seen in the table just now, which restarts the fingerprint's FINGERPRINT_MAX_AGE_SECONDS
+    record_fingerprints[fingerprint_key] = [fingerprint, int(time.time())]
+    changed_fingerprint_keys.add(fingerprint_key)
+
+
+def get_fingerprint_key(table_name, item):
+    return json.dumps([table_name] + [item[key_name] for key_name in TABLE_KEYS[table_name]], default = str)
+
+
+def get_fingerprint(table_name, item):
+    # Only the fields coming from the feed count, the preserved fields change without the feed changing
+    feed_fields = {field_name: value for field_name, value in item.items() if field_name not in PRESERVED_FIELDS[table_name]}
+    return hashlib.blake2b(json.dumps(feed_fields, sort_keys = True, default = str).encode('utf-8'), digest_size = 16).hexdigest()
+
+
+def print_fingerprint_counts():
+    for table_name, counts in fingerprint_counts.items():
+        print(f"Fingerprints for {table_name}: {counts['hits']} hits (unchanged, skipped), {counts['misses']} misses")
+
+
+def load_state_object(key):
+    # Returns the JSON state object stored under key in S3_BUCKET, or None if it doesn't exist yet
+    try:
+        response = s3.get_object(Bucket = S3_BUCKET, Key = key)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def save_state_object(key, state):
+    s3.put_object(Bucket = S3_BUCKET, Key = key, Body = json.dumps(state).encode('utf-8'), ContentType = 'application/json')
+
+
+def print_record_counts():
+    for table_name, counts in record_counts.items():
+        print(f"Records in {table_name}: " + ', '.join(f"{counts[outcome]} {outcome}" for outcome in sorted(counts)))
+
+
+def submit_record(table_name, function, *args):
+    if CONCURRENT_WRITES:
+        get_worker_pool(table_name).submit(function, *args)
+    else:
+        function(*args)
+
+
+def get_worker_pool(name, workers = None):
+    with worker_pools_lock:
+        if name not in worker_pools:
+            worker_pools[name] = TableWorkerPool(name, workers or TABLE_WORKERS[name], TABLE_QUEUE_SIZE)
+        return worker_pools[name]
+
+
+def drain_worker_pools(*names):
+    for name in names:
+        if name in worker_pools:
+            worker_pools[name].drain()
+
+
+def shutdown_worker_pools():
+    for worker_pool in worker_pools.values():
+        worker_pool.shutdown()
+    worker_pools.clear()
+
+
+class TableWorkerPool:
+    # Thread pool for the records of one table, at most workers + queue_size records are submitted but not finished
+    # at any time so a fast feed reader can't queue up the whole feed in memory
+
+    def __init__(self, table_name, workers, queue_size):
+        self.table_name = table_name
+        self.capacity = workers + queue_size
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = f"{table_name}-worker")
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._record_done)
+        return future
+
+    def _record_done(self, future):
+        # The record functions print their own errors, this only catches anything that escaped them
+        if future.exception() is not None:
+            count_record(self.table_name, 'failed')
+            print(f"Error processing record for table {self.table_name}. Exception: {future.exception()}")
+        self.slots.release()
+
+    def drain(self):
+        # Holding every slot means nothing is queued or in flight, they are handed straight back afterwards
+        for _ in range(self.capacity):
+            self.slots.acquire()
+        for _ in range(self.capacity):
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+
+
+class ImportCheckpoint:
+    # Tells the section importers when the invocation is about to run out of time and keeps track of how far
+    # each section got, as [record index, season index, episode index] per section name
+
+    def __init__(self, context):
+        self.context = context
+        self.stopped = threading.Event()
+        self.positions = {}
+        self.completed_sections = []
+        self.resumed = False
+        self.earlier_failures = False
+
+    def resume_from(self, cursor):
+        self.positions = dict(cursor['positions'])
+        self.completed_sections = list(cursor['completedSections'])
+        self.earlier_failures = cursor.get('failures', False)
+        self.resumed = True
+
+    def out_of_time(self):
+        if not self.stopped.is_set() and CHECKPOINT_BEFORE_TIMEOUT and self.context is not None:
+            if self.context.get_remaining_time_in_millis() < CHECKPOINT_SAFETY_MARGIN_MS:
+                self.stopped.set()
+        return self.stopped.is_set()
+
+    def get_position(self, section_name):
+        return self.positions.get(section_name, [0, 0, 0])
+
+    def set_position(self, section_name, record_index, season_index = 0, episode_index = 0):
+        self.positions[section_name] = [record_index, season_index, episode_index]
+
+    def is_section_completed(self, section_name):
+        return section_name in self.completed_sections
+
+    def complete_section(self, section_name):
+        self.completed_sections.append(section_name)
+        self.positions.pop(section_name, None)
+
+    def get_cursor(self, etag):
+        return {
+            'etag': etag,
+            'positions': self.positions,
+            'completedSections': self.completed_sections,
+            'failures': self.earlier_failures or import_failures.is_set()
+            }
+
+
+def iter_prefetch_windows(records, prefetch):
+    # Without prefetching all records are one window taken off the feed as they are processed, so none are held back
+    if not prefetch:
+        yield records
+        return
+
+    records = iter(records)
+
+    while True:
+        window = list(itertools.islice(records, PREFETCH_WINDOW_SIZE))
+        if not window:
+            return
+        yield window
+
+
+def clear_prefetched_records(*table_names):
+    for table_name in table_names:
+        prefetched_records[table_name].clear()
+
+
+def find_existing_movies(movie):
+    prefetch_key = (movie['title'], movie['releaseDate'])
+    if prefetch_key in prefetched_records[MOVIE_TABLE]:
+        existing_movie = prefetched_records[MOVIE_TABLE][prefetch_key]
+        return [existing_movie] if existing_movie else []
+    if is_definitely_absent(MOVIE_TABLE, prefetch_key):
+        return []
+
+    return get_dynamo_record_by_pk_and_field_value('name', movie['title'], 'year', movie['releaseDate'], movie_table)['Items']
+
+
+def find_existing_tv_show(tv_show):
+    prefetch_key = (tv_show['title'],)
+    if prefetch_key in prefetched_records[TV_SHOW_TABLE]:
+        return prefetched_records[TV_SHOW_TABLE][prefetch_key]
+    if is_definitely_absent(TV_SHOW_TABLE, prefetch_key):
+        return None
+
+    existing_tv_shows = get_dynamo_record_by_pk('name', tv_show['title'], tv_show_table)['Items']
+    return existing_tv_shows[0] if len(existing_tv_shows) == 1 else None
+
+
+def find_existing_episode(tv_show, season_and_episode, episode_index = None):
+    if episode_index is not None:
+        return episode_index.get(season_and_episode)
+
+    prefetch_key = (tv_show['title'], season_and_episode)
+    if prefetch_key in prefetched_records[EPISODE_TABLE]:
+        return prefetched_records[EPISODE_TABLE][prefetch_key]
+    if is_definitely_absent(EPISODE_TABLE, prefetch_key):
+        return None
+
+    existing_episodes = get_dynamo_record_by_pk_and_sk('tvShowName', tv_show['title'], 'seasonAndEpisode', season_and_episode, episode_table)['Items']
+    return existing_episodes[0] if len(existing_episodes) == 1 else None
+
+
+def load_episode_index(tv_show_name):
+    # Returns every existing episode of the show keyed on seasonAndEpisode, or None if the Query failed
+    # in which case the episodes are looked up one by one
+    projection_expression, attribute_names = get_projection(EPISODE_TABLE)
+    query_arguments = {
+        'KeyConditionExpression': Key('tvShowName').eq(tv_show_name),
+        'ProjectionExpression': projection_expression,
+        'ExpressionAttributeNames': attribute_names
+        }
+    episode_index = {}
+
+    try:
+        while True:
+            response = call_dynamodb(EPISODE_TABLE, 'read', 1, episode_table.query, **query_arguments)
+            for item in response['Items']:
+                episode_index[item['seasonAndEpisode']] = item
+
+            if 'LastEvaluatedKey' not in response:
+                return episode_index
+            query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except Exception as ex:
+        print(f"Error loading existing episodes of TV Show: {tv_show_name}. Exception: {ex}")
+        return None
+
+
+def get_projection(table_name):
+    # Only the key and preserved fields are needed, placeholders because name and year are reserved words
+    attribute_names = TABLE_KEYS[table_name] + PRESERVED_FIELDS[table_name]
+    projection_expression = ', '.join(f"#attr{index}" for index in range(len(attribute_names)))
+    return projection_expression, {f"#attr{index}": attribute_name for index, attribute_name in enumerate(attribute_names)}
+
+
+def prefetch_existing_records(keys_by_table):
+    for table_name, keys in keys_by_table.items():
+        # BatchGetItem rejects requests containing the same key twice
+        unique_keys = [key for key in dict.fromkeys(keys) if not is_definitely_absent(table_name, key)]
+        for start in range(0, len(unique_keys), BATCH_GET_SIZE):
+            batch_get_existing_records(table_name, unique_keys[start:start + BATCH_GET_SIZE])
+
+
+def batch_get_existing_records(table_name, keys):
+    key_names = TABLE_KEYS[table_name]
+    projection_expression, attribute_names = get_projection(table_name)
+    request = {
+        'Keys': [dict(zip(key_names, key)) for key in keys],
+        'ProjectionExpression': projection_expression,
+        'ExpressionAttributeNames': attribute_names
+        }
+    found = {}
+    unprocessed_keys = []
+    attempt = 0
+
+    try:
+        while True:
+            response = call_dynamodb(table_name, 'read', len(request['Keys']) / 2, dynamodb.batch_get_item, RequestItems = {table_name: request})
+            for item in response['Responses'].get(table_name, []):
+                found[tuple(item[key_name] for key_name in key_names)] = item
+
+            unprocessed = response.get('UnprocessedKeys', {}).get(table_name)
+            if not unprocessed:
+                break
+
+            attempt += 1
+            if attempt > BATCH_GET_MAX_RETRIES:
+                # Whatever is left is looked up record by record later on
+                unprocessed_keys = [tuple(key[key_name] for key_name in key_names) for key in unprocessed['Keys']]
+                print(f"Error prefetching {len(unprocessed_keys)} records from table {table_name}. Exception: still unprocessed after {BATCH_GET_MAX_RETRIES} retries")
+                break
+
+            import_metrics.count(table_name, 'Retried', len(unprocessed['Keys']))
+            backoff_sleep(attempt)
+            request = unprocessed
+    except Exception as ex:
+        print(f"Error prefetching records from table {table_name}. Exception: {ex}")
+        return
+
+    unprocessed_keys = set(unprocessed_keys)
+    for key in keys:
+        if key not in unprocessed_keys:
+            prefetched_records[table_name][key] = found.get(key)
+
+
+def backoff_sleep(attempt):
+    # Exponential backoff with full jitter as recommended for unprocessed items and keys
+    time.sleep(random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BASE_BACKOFF_SECONDS * 2 ** attempt)))
+
+
+def call_dynamodb(table_name, capacity, estimated_units, function, phase = None, **arguments):
+    # Every DynamoDb request of the importer goes through here. capacity is 'read' or 'write' and estimated_units
+    # the capacity units the request is expected to consume, the bucket is corrected with the consumed capacity
+    # DynamoDb returns once the request is done.
+    # Reads are timed as the lookup phase of the table and writes as the write phase, waits and retries included.
+    # The consumed capacity is accounted to phase, 'lookup' for reads and 'write' for writes unless given. phase can
+    # also be a function picking it from the response, or the number of items per phase of a batch.
+    if phase is None:
+        phase = 'lookup' if capacity == 'read' else 'write'
+    if TRACK_CONSUMED_CAPACITY or RATE_LIMIT_REQUESTS:
+        arguments['ReturnConsumedCapacity'] = 'TOTAL'
+
+    with import_metrics.span('Lookup' if capacity == 'read' else 'Write', table_name):
+        try:
+            if RATE_LIMIT_REQUESTS:
+                response = call_rate_limited(table_name, capacity, estimated_units, function, **arguments)
+            else:
+                response = timed_call(function, **arguments)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                # A write rejected by its condition is charged all the same, the error doesn't say how much
+                capacity_usage.add(table_name, capacity, phase, estimated_units)
+            raise
+
+    capacity_usage.add(table_name, capacity, phase(response) if callable(phase) else phase, get_consumed_units(response))
+    return response
+
+
+def call_rate_limited(table_name, capacity, estimated_units, function, **arguments):
+    rate_limiter = get_rate_limiter(table_name, capacity)
+    attempt = 0
+
+    while True:
+        rate_limiter.acquire(estimated_units)
+        try:
+            response = timed_call(function, **arguments)
+        except ClientError as ex:
+            error_code = ex.response['Error']['Code']
+            if error_code in ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'):
+                rate_limiter.throttled()
+            elif error_code not in ('InternalServerError', 'ServiceUnavailable'):
+                raise
+
+            attempt += 1
+            if attempt > RATE_LIMIT_MAX_RETRIES:
+                raise
+            import_metrics.count(table_name, 'Retried')
+            backoff_sleep(attempt)
+            continue
+        except (BotocoreConnectionError, HTTPClientError):
+            # Connection failures and timeouts, which boto3 would have retried if it was still retrying
+            attempt += 1
+            if attempt > RATE_LIMIT_MAX_RETRIES:
+                raise
+            import_metrics.count(table_name, 'Retried')
+            backoff_sleep(attempt)
+            continue
+
+        rate_limiter.consumed(estimated_units, get_consumed_units(response))
+        return response
+
+
+def timed_call(function, **arguments):
+    # Adds the latency of a single DynamoDb request to the histogram of its operation
+    started = time.perf_counter()
+    try:
+        return function(**arguments)
+    finally:
+        import_metrics.observe_latency(function.__name__, time.perf_counter() - started)
+
+
+def get_consumed_units(response):
+    # Single table requests return one ConsumedCapacity, batch requests a list with one per table
+    consumed_capacity = response.get('ConsumedCapacity') or []
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    return sum(table_capacity.get('CapacityUnits', 0) for table_capacity in consumed_capacity)
+
+
+def get_rate_limiter(table_name, capacity):
+    with rate_limiters_lock:
+        if (table_name, capacity) not in rate_limiters:
+            for table_capacity, units in get_table_capacity(table_name).items():
+                target_rate = max(RATE_LIMIT_MIN_RATE, units * RATE_LIMIT_CAPACITY_PERCENT / 100)
+                rate_limiters[(table_name, table_capacity)] = CapacityRateLimiter(f"{table_name} {table_capacity}", target_rate)
+        return rate_limiters[(table_name, capacity)]
+
+
+def get_table_capacity(table_name):
+    # Provisioned read and write capacity units of the table, on-demand tables report 0 for both
+    try:
+        throughput = describe_table(table_name).get('ProvisionedThroughput', {})
+    except Exception as ex:
+        print(f"Error reading capacity of table {table_name}. Exception: {ex}")
+        throughput = {}
+
+    return {
+        'read': throughput.get('ReadCapacityUnits') or RATE_LIMIT_ON_DEMAND_CAPACITY['read'],
+        'write': throughput.get('WriteCapacityUnits') or RATE_LIMIT_ON_DEMAND_CAPACITY['write']
+        }
+
+
+class CapacityRateLimiter:
+    # Token bucket holding up to one second of capacity units. Requests take their estimated units up front and wait
+    # while the bucket is in debt, the difference to the units actually consumed is settled afterwards.
+
+    def __init__(self, name, target_rate):
+        self.name = name
+        self.target_rate = target_rate
+        self.rate = target_rate
+        self.tokens = target_rate
+        self.updated = time.monotonic()
+        self.last_increase = self.updated
+        self.lock = threading.Lock()
+        self.throttles = 0
+
+    def acquire(self, units):
+        with self.lock:
+            self._refill()
+            self.tokens -= units
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait_seconds:
+            time.sleep(wait_seconds)
+
+    def consumed(self, estimated_units, consumed_units):
+        with self.lock:
+            self.tokens -= consumed_units - estimated_units
+
+            # Additive increase, once a second while requests go through
+            now = time.monotonic()
+            if now - self.last_increase >= 1 and self.rate < self.target_rate:
+                self.rate = min(self.target_rate, self.rate + self.target_rate * RATE_LIMIT_INCREASE_PERCENT / 100)
+                self.last_increase = now
+
+    def throttled(self):
+        # Multiplicative decrease, the bucket is emptied as well so the waiting requests spread out at the new rate
+        with self.lock:
+            self._refill()
+            self.rate = max(RATE_LIMIT_MIN_RATE, self.rate * RATE_LIMIT_DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0)
+            self.last_increase = time.monotonic()
+            self.throttles += 1
+            if self.throttles == 1 or self.throttles % 100 == 0:
+                print(f"Throttled on {self.name}, rate lowered to {self.rate:.1f} capacity units per second ({self.throttles} throttles).")
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class ImportMetrics:
+    # Time spent per phase and table, retries per table and latency histograms per DynamoDb operation of one invocation,
+    # printed as CloudWatch Embedded Metric Format at the end. Phases running on several workers at once add up,
+    # so a phase can take longer in total than the import itself.
+
+    # Counter each outcome in record_counts adds to, records 'already present' or 'unchanged' were skipped
+    COUNTED_OUTCOMES = {
+        'inserted': 'Inserted',
+        'updated': 'Updated',
+        'already present': 'Skipped',
+        'unchanged': 'Skipped',
+        'failed': 'Failed'
+    }
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phase_seconds = {}
+        self.counters = {}
+        self.latencies = {}
+
+    @contextlib.contextmanager
+    def span(self, phase, table_name = None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, table_name, time.perf_counter() - started)
+
+    def add_time(self, phase, table_name, seconds):
+        with self.lock:
+            self.phase_seconds[(phase, table_name)] = self.phase_seconds.get((phase, table_name), 0) + seconds
+
+    def count(self, table_name, counter, amount = 1):
+        with self.lock:
+            self.counters[(table_name, counter)] = self.counters.get((table_name, counter), 0) + amount
+
+    def observe_latency(self, function_name, seconds):
+        # boto3 names the methods of its resources after the snake case form of the operation
+        operation = ''.join(part.title() for part in function_name.split('_'))
+        with self.lock:
+            if operation not in self.latencies:
+                self.latencies[operation] = LatencyHistogram()
+            self.latencies[operation].add(seconds * 1000)
+
+    def emit(self, status):
+        duration = time.perf_counter() - self.started
+        timestamp = int(time.time() * 1000)
+        records = sum(sum(counts.values()) for counts in record_counts.values())
+
+        print_metrics(timestamp, {}, {
+            'ImportTime': (round(duration * 1000, 3), 'Milliseconds'),
+            'Records': (records, 'Count'),
+            'RecordsPerSecond': (round(records / duration, 1) if duration else 0, 'Count/Second'),
+            'S3DownloadTime': (self.get_milliseconds('S3Download'), 'Milliseconds'),
+            'JsonParseTime': (self.get_milliseconds('JsonParse'), 'Milliseconds'),
+            'FeedDiffTime': (self.get_milliseconds('FeedDiff'), 'Milliseconds')
+            }, {'Status': status})
+
+        for table_name in (MOVIE_TABLE, TV_SHOW_TABLE, EPISODE_TABLE):
+            counts = {counter: 0 for counter in ('Inserted', 'Updated', 'Skipped', 'Failed')}
+            for outcome, count in record_counts.get(table_name, {}).items():
+                counts[self.COUNTED_OUTCOMES[outcome]] += count
+            table_records = sum(counts.values())
+
+            metrics = {counter: (count, 'Count') for counter, count in counts.items()}
+            metrics['Retried'] = (self.counters.get((table_name, 'Retried'), 0), 'Count')
+            metrics['RecordsPerSecond'] = (round(table_records / duration, 1) if duration else 0, 'Count/Second')
+            for phase in ('Lookup', 'BuildItem', 'Write'):
+                metrics[phase + 'Time'] = (self.get_milliseconds(phase, table_name), 'Milliseconds')
+            if TRACK_CONSUMED_CAPACITY:
+                metrics['ConsumedReadCapacityUnits'] = (round(capacity_usage.get_units(table_name, 'read'), 1), 'Count')
+                metrics['ConsumedWriteCapacityUnits'] = (round(capacity_usage.get_units(table_name, 'write'), 1), 'Count')
+            print_metrics(timestamp, {'Table': table_name}, metrics)
+
+        for operation, histogram in sorted(self.latencies.items()):
+            print_metrics(timestamp, {'Operation': operation}, {
+                'Calls': (histogram.count, 'Count'),
+                'LatencyP50': (histogram.percentile(50), 'Milliseconds'),
+                'LatencyP95': (histogram.percentile(95), 'Milliseconds'),
+                'LatencyP99': (histogram.percentile(99), 'Milliseconds'),
+                'LatencyMax': (round(histogram.max_milliseconds, 3), 'Milliseconds')
+                })
+
+    def get_milliseconds(self, phase, table_name = None):
+        return round(self.phase_seconds.get((phase, table_name), 0) * 1000, 3)
+
+
+def print_metrics(timestamp, dimensions, metrics, properties = None):
+    # One Embedded Metric Format line, metrics maps names to (value, unit)
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': IMPORT_METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+                }]
+            },
+        **dimensions,
+        **(properties or {}),
+        **{name: value for name, (value, unit) in metrics.items()}
+        }))
+
+
+class LatencyHistogram:
+    # Latencies counted in buckets growing by BUCKET_RATIO from SMALLEST_MILLISECONDS, so percentiles are exact
+    # to within that ratio however many requests are made
+
+    BUCKET_RATIO = 1.05
+    SMALLEST_MILLISECONDS = 0.1
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.max_milliseconds = 0
+
+    def add(self, milliseconds):
+        bucket = max(0, math.ceil(math.log(max(milliseconds, self.SMALLEST_MILLISECONDS) / self.SMALLEST_MILLISECONDS, self.BUCKET_RATIO)))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.max_milliseconds = max(self.max_milliseconds, milliseconds)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return round(min(self.max_milliseconds, self.SMALLEST_MILLISECONDS * self.BUCKET_RATIO ** bucket), 3)
+        return 0
+
+
+class CapacityUsage:
+    # Capacity units consumed per table, 'read' or 'write' and phase ('lookup', 'insert', 'update') in the current
+    # invocation, from the ConsumedCapacity DynamoDb returns
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # table name -> 'read' or 'write' -> phase -> capacity units, plain dicts so shard results can carry them
+        self.units = {}
+
+    def add(self, table_name, capacity, phase, units):
+        # phase can be the number of items per phase of a batch, the units are then split between the phases
+        shares = phase if isinstance(phase, dict) else {phase: 1}
+        total_shares = sum(shares.values())
+        with self.lock:
+            phases = self.units.setdefault(table_name, {}).setdefault(capacity, {})
+            for phase_name, share in shares.items():
+                phases[phase_name] = phases.get(phase_name, 0) + units * share / total_shares
+
+    def merge(self, units):
+        for table_name, capacities in units.items():
+            for capacity, phases in capacities.items():
+                for phase, phase_units in phases.items():
+                    self.add(table_name, capacity, phase, phase_units)
+
+    def get_units(self, table_name, capacity):
+        with self.lock:
+            return sum(self.units.get(table_name, {}).get(capacity, {}).values())
+
+    def get_cost(self, table_name):
+        # On-demand tables are billed one request unit per capacity unit consumed
+        return sum(self.get_units(table_name, capacity) * ON_DEMAND_PRICE_PER_MILLION_UNITS[capacity] / 1000000 for capacity in ('read', 'write'))
+
+    def print_report(self):
+        for table_name, capacities in sorted(self.units.items()):
+            consumed = [
+                f"{units:.1f} {'RCU' if capacity == 'read' else 'WCU'} {phase}"
+                for capacity in ('read', 'write') for phase, units in sorted(capacities.get(capacity, {}).items())
+                ]
+            print(f"Capacity consumed in {table_name}: {', '.join(consumed)}, estimated on-demand cost ${self.get_cost(table_name):.6f}")
+
+        if self.units:
+            read_units = sum(self.get_units(table_name, 'read') for table_name in self.units)
+            write_units = sum(self.get_units(table_name, 'write') for table_name in self.units)
+            cost = sum(self.get_cost(table_name) for table_name in self.units)
+            print(f"Capacity consumed in total: {read_units:.1f} RCU, {write_units:.1f} WCU, estimated on-demand cost ${cost:.6f}")
+
+
+def build_movie_item(movie, date_added, last_watched = None, views = 0, trailer_url = None):
+    with import_metrics.span('BuildItem', MOVIE_TABLE):
+        return {
+            'name': movie['title'], 
+            'year': movie['releaseDate'], 
+            'description': movie['longDescription'],
+            'thumbnailUrl': movie['thumbnail'], 
+            'rating': movie['rating'], 
+            'cast': movie['cast'], 
+            'director': movie['director'], 
+            'genres': movie['genres'], 
+            'duration': movie['content']['duration'], 
+            'videoType': movie['content']['videos'][0]['videoType'], 
+            'videoUrl': movie['content']['videos'][0]['url'], 
+            'trailerUrl': trailer_url,
+            'dateAdded': date_added, 
+            'lastWatched': last_watched,
+            'views': views
+            }
+
+
+def build_tv_show_item(tv_show, date_added, last_watched = None, views = 0):
+    with import_metrics.span('BuildItem', TV_SHOW_TABLE):
+        return {
+            'name': tv_show['title'], 
+            'description': tv_show['shortDescription'],
+            'thumbnailUrl': tv_show['thumbnail'],
+            'releaseDate': tv_show['releaseDate'],
+            "firstAired": tv_show["releaseDate"][:4],
+            'rating': tv_show['rating'],
+            'cast': tv_show['cast'],
+            'director': tv_show['director'],
+            'genres': tv_show['genres'],
+            'numberOfSeasons': len(tv_show['seasons']),
+            'dateAdded': date_added, 
+            'lastWatched': last_watched,
+            'views': views
+            }
+
+
+def build_episode_item(tv_show, season, episode, season_and_episode, date_added, last_watched = None, views = 0):
+    with import_metrics.span('BuildItem', EPISODE_TABLE):
+        return {
+            'tvShowName': tv_show['title'], 
+            'seasonAndEpisode': season_and_episode,
+            'season': season['title'],
+            'episode': episode['episodeNumber'],
+            'name': episode['title'],
+            'description': episode['longDescription'],
+            'thumbnailUrl': episode['thumbnail'],
+            'releaseDate': episode['releaseDate'],
+            'rating': episode['rating'],
+            'cast': episode['cast'],
+            'director': episode['director'],
+            'genres': episode['genres'],
+            'videoType': episode['content']['videos'][0]['videoType'],
+            'videoUrl': episode['content']['videos'][0]['url'],
+            'duration': episode['content']['duration'],
+            'dateAdded': date_added, 
+            'lastWatched': last_watched,
+            'views': views
+            }
+
+
+def get_season_and_episode(season, episode):
+    if notSpecialSeason(season['title']):
+        season_number_padded = f"{int(season['title']):02}"  # e.g., '1' -> '01'
+        episode_number_padded = f"{int(episode['episodeNumber']):02}"  # e.g., 3 -> '03'
+        return f"S{season_number_padded} E{episode_number_padded}"
+    else:
+        episode_number_padded = str(f"{int(episode['episodeNumber']):02}")
+        return f"{season['title']} E{episode_number_padded}"
+
+
+def write_item(table, item, phase = 'insert', message = None):
+    # phase is 'insert' for a new record and 'update' for an existing one, the capacity used is accounted to it.
+    # The record is counted as inserted or updated and message is printed once the write went through, for a batched
+    # item that's when its batch was sent. Batched items are invalidated again then, a lookup in between still finds them missing
+    lookup_cache.invalidate(table.name, item)
+
+    if is_definitely_absent(table.name, get_item_key(table.name, item)):
+        if not put_item_not_in_key_filter(table, item):
+            write_existing_item(table, item)
+            return
+        count_written_item(table.name, item, phase, message)
+    elif USE_BATCH_WRITES:
+        get_batch_writer(table).put(item, phase, message)
+    else:
+        call_dynamodb(table.name, 'write', 1, table.put_item, phase = phase, Item = item)
+        count_written_item(table.name, item, phase, message)
+
+    # Keeps the startup index in step so a record repeated in the feed is seen as existing, like a Query would
+    if table.name in existing_key_indexes:
+        add_to_key_index(table.name, item)
+
+
+def write_existing_item(table, item):
+    # The key filter had the record as new but it exists, it's looked up and handled like the lookup had found it
+    key = get_item_key(table.name, item)
+    response = call_dynamodb(table.name, 'read', 1, table.get_item, Key = dict(zip(TABLE_KEYS[table.name], key)))
+    existing_item = response.get('Item')
+
+    if existing_item is None:
+        # Deleted again in the meantime, it's written like any other new record
+        write_item(table, item)
+    elif get_update_existing_data(table.name):
+        preserved_fields = {field_name: existing_item[field_name] for field_name in PRESERVED_FIELDS[table.name] if field_name in existing_item}
+        write_item(table, {**item, **preserved_fields}, 'update')
+    else:
+        count_record(table.name, 'already present', item)
+
+
+def get_update_existing_data(table_name):
+    return {MOVIE_TABLE: UPDATE_EXISTING_MOVIE_DATA, TV_SHOW_TABLE: UPDATE_EXISTING_TV_DATA, EPISODE_TABLE: UPDATE_EXISTING_EPISODE_DATA}[table_name]
+
+
+def count_written_item(table_name, item, phase, message = None):
+    count_record(table_name, 'inserted' if phase == 'insert' else 'updated', item)
+    if message:
+        print(message)
+
+
+def get_batch_writer(table):
+    with batch_writers_lock:
+        if table.name not in batch_writers:
+            batch_writers[table.name] = BatchWriter(table)
+        return batch_writers[table.name]
+
+
+def flush_batch_writes(*tables):
+    for table in tables:
+        if table.name in batch_writers:
+            writer = batch_writers.pop(table.name)
+            writer.flush()
+            print(f"Batch writes to {table.name}: {writer.items_written} items written, {writer.batches_sent} batches sent, {writer.items_retried} items retried, {writer.items_failed} items failed")
+
+
+class BatchWriter:
+    # Groups put requests for one table into BatchWriteItem calls of up to BATCH_WRITE_SIZE items.
+    # Safe to share between worker threads, batches are taken under the lock but sent outside of it.
+
+    def __init__(self, table):
+        self.table = table
+        self.key_names = TABLE_KEYS[table.name]
+        self.lock = threading.Lock()
+        # (item, phase, message) keyed on the item's primary key since a single BatchWriteItem call can't contain the same key twice,
+        # a later put for a key that is still pending replaces the earlier one just like sequential put_item calls would
+        self.pending = {}
+        self.items_written = 0
+        self.batches_sent = 0
+        self.items_retried = 0
+        self.items_failed = 0
+
+    def put(self, item, phase = 'insert', message = None):
+        with self.lock:
+            self.pending[tuple(item[key_name] for key_name in self.key_names)] = (item, phase, message)
+            batch = self._take_batch() if len(self.pending) >= BATCH_WRITE_SIZE else None
+
+        if batch:
+            self._send(batch)
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._send(batch)
+
+    def _take_batch(self):
+        batch = list(self.pending.values())[:BATCH_WRITE_SIZE]
+        for item, _, _ in batch:
+            del self.pending[tuple(item[key_name] for key_name in self.key_names)]
+        return batch
+
+    def _send(self, batch):
+        items = [item for item, _, _ in batch]
+        # The capacity of a batch is split between inserts and updates by their number of items
+        phases = collections.Counter(phase for _, phase, _ in batch)
+        request_items = {self.table.name: [{'PutRequest': {'Item': item}} for item in items]}
+        unprocessed = []
+        batches_sent = 0
+        items_retried = 0
+        attempt = 0
+
+        try:
+            while True:
+                batches_sent += 1
+                response = call_dynamodb(self.table.name, 'write', len(request_items[self.table.name]), dynamodb.batch_write_item, phase = dict(phases), RequestItems = request_items)
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table.name, [])
+
+                if not unprocessed:
+                    break
+
+                attempt += 1
+                if attempt > BATCH_WRITE_MAX_RETRIES:
+                    for request in unprocessed:
+                        print(f"Error writing item {self._describe(request['PutRequest']['Item'])} to table {self.table.name}. Exception: still unprocessed after {BATCH_WRITE_MAX_RETRIES} retries")
+                    break
+
+                items_retried += len(unprocessed)
+                import_metrics.count(self.table.name, 'Retried', len(unprocessed))
+                backoff_sleep(attempt)
+                request_items = {self.table.name: unprocessed}
+        except Exception as ex:
+            unprocessed = request_items[self.table.name]
+            for request in unprocessed:
+                print(f"Error writing item {self._describe(request['PutRequest']['Item'])} to table {self.table.name}. Exception: {ex}")
+
+        for item in items:
+            lookup_cache.invalidate(self.table.name, item)
+
+        # Records are only counted now that it's known whether their write went through
+        unprocessed_keys = {tuple(request['PutRequest']['Item'][key_name] for key_name in self.key_names) for request in unprocessed}
+        for item, phase, message in batch:
+            if tuple(item[key_name] for key_name in self.key_names) in unprocessed_keys:
+                count_record(self.table.name, 'failed')
+            else:
+                count_written_item(self.table.name, item, phase, message)
+
+        with self.lock:
+            self.batches_sent += batches_sent
+            self.items_retried += items_retried
+            self.items_failed += len(unprocessed)
+            self.items_written += len(items) - len(unprocessed)
+
+    def _describe(self, item):
+        return ', '.join(str(item[key_name]) for key_name in self.key_names)
+
+
+def notSpecialSeason(season_name):
+    if season_name != 'Pilot' and season_name != 'Extras' and season_name != 'Movies' and season_name != 'Mini Series':
+        return True
+    else:
+        return False
+
+
+def load_existing_key_index(table_name):
+    print(f"Indexing existing records of table {table_name}.")
+
+    key_index = {}
+    key_index_lock = threading.Lock()
+    over_limit = threading.Event()
+
+    def index_items(items):
+        with key_index_lock:
+            for item in items:
+                key_index[get_item_key(table_name, item)] = get_preserved_values(table_name, item)
+            if len(key_index) > SCAN_MAX_INDEXED_ITEMS:
+                over_limit.set()
+
+    try:
+        scan_existing_records(table_name, index_items, stop_scanning = over_limit)
+    except Exception as ex:
+        print(f"Error indexing existing records of table {table_name}. Exception: {ex}")
+        return
+
+    if over_limit.is_set():
+        print(f"Table {table_name} has more than {SCAN_MAX_INDEXED_ITEMS} records, records will be looked up while importing instead.")
+        return
+
+    existing_key_indexes[table_name] = key_index
+    print(f"Indexed {len(key_index)} existing records of table {table_name}.")
+
+
+def scan_existing_records(table_name, handle_items, filter_expression = None, stop_scanning = None):
+    # Parallel Scan of the key and preserved fields of the table's records, handle_items is called with the items of
+    # every page on the scanning threads. Returns the number of items scanned.
+    table = dynamodb.Table(table_name)
+    projection_expression, attribute_names = get_projection(table_name)
+
+    def scan_segment(segment):
+        scan_arguments = {
+            'Segment': segment,
+            'TotalSegments': SCAN_TOTAL_SEGMENTS,
+            'ProjectionExpression': projection_expression,
+            'ExpressionAttributeNames': dict(attribute_names)
+            }
+        if filter_expression is not None:
+            scan_arguments['FilterExpression'] = filter_expression
+        item_count = 0
+
+        while not (stop_scanning and stop_scanning.is_set()):
+            response = call_dynamodb(table_name, 'read', 1, table.scan, **scan_arguments)
+            handle_items(response['Items'])
+            item_count += len(response['Items'])
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return item_count
+
+    with ThreadPoolExecutor(max_workers = SCAN_TOTAL_SEGMENTS, thread_name_prefix = f"{table_name}-scan") as executor:
+        return sum(future.result() for future in [executor.submit(scan_segment, segment) for segment in range(SCAN_TOTAL_SEGMENTS)])
+
+
+def load_local_mirror(table_name):
+    global local_mirror
+
+    if local_mirror is None:
+        local_mirror = LocalMirror(LOCAL_MIRROR_PATH)
+
+    if local_mirror.refresh(table_name):
+        existing_key_indexes[table_name] = LocalMirrorIndex(local_mirror, table_name)
+
+
+class LocalMirror:
+    # SQLite database in /tmp with the key and preserved fields of every record of the mirrored tables, indexed on
+    # (table name, key). One connection shared by all threads, every statement runs under the lock.
+    # mirror_state holds per table when the mirror was built, the time it's up to date with as a dateAdded/lastWatched
+    # high-water mark, whether an import is using it and may have written to it without the writes reaching DynamoDb,
+    # and when it was last refreshed.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+        try:
+            self.connection = self._connect()
+        except sqlite3.DatabaseError as ex:
+            # A container stopped in the middle of a write can leave a damaged file behind, the mirror is only a copy
+            print(f"Error opening local mirror {path}, building it again. Exception: {ex}")
+            os.remove(path)
+            self.connection = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread = False, isolation_level = None)
+        # Nothing is lost if the file doesn't survive, so writes don't wait for the disk
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('CREATE TABLE IF NOT EXISTS records (table_name TEXT, record_key TEXT, preserved_fields TEXT, PRIMARY KEY (table_name, record_key))')
+        # A mirror written before refreshed_at was tracked is built again
+        if 'refreshed_at' not in [column[1] for column in connection.execute('PRAGMA table_info(mirror_state)')]:
+            connection.execute('DROP TABLE IF EXISTS mirror_state')
+        connection.execute('CREATE TABLE IF NOT EXISTS mirror_state (table_name TEXT PRIMARY KEY, built_at REAL, refreshed_through TEXT, in_use INTEGER, refreshed_at REAL)')
+        return connection
+
+    def refresh(self, table_name):
+        # Brings the table's mirror up to date, returns False when it couldn't be and lookups have to go to DynamoDb
+        with self.lock:
+            state = self.connection.execute('SELECT built_at, refreshed_through, in_use, refreshed_at FROM mirror_state WHERE table_name = ?', (table_name,)).fetchone()
+
+        if state is not None and not state[2] and time.time() - state[3] < LOCAL_MIRROR_REUSE_SECONDS and time.time() - state[0] <= LOCAL_MIRROR_MAX_AGE_SECONDS:
+            print(f"Using local mirror of table {table_name} refreshed {int(time.time() - state[3])} seconds ago.")
+            with self.lock:
+                self.connection.execute('UPDATE mirror_state SET in_use = 1 WHERE table_name = ?', (table_name,))
+            return True
+
+        # Same format as dateAdded and lastWatched so they compare as strings
+        refresh_started = (datetime.today() - timedelta(seconds = LOCAL_MIRROR_REFRESH_OVERLAP_SECONDS)).strftime('%Y-%m-%d %H:%M:%S %f')[:-3]
+
+        if state is None or state[2] or time.time() - state[0] > LOCAL_MIRROR_MAX_AGE_SECONDS:
+            print(f"Building local mirror of table {table_name}.")
+            with self.lock:
+                self.connection.execute('DELETE FROM mirror_state WHERE table_name = ?', (table_name,))
+                self.connection.execute('DELETE FROM records WHERE table_name = ?', (table_name,))
+            built_at = time.time()
+            filter_expression = None
+        else:
+            # Reads the whole table like a rebuild, see USE_LOCAL_MIRROR
+            print(f"Refreshing local mirror of table {table_name} with records added or watched since {state[1]}.")
+            built_at = state[0]
+            filter_expression = Attr('dateAdded').gt(state[1]) | Attr('lastWatched').gt(state[1])
+
+        refreshed_at = time.time()
+        try:
+            record_count = scan_existing_records(table_name, lambda items: self.put_items(table_name, items), filter_expression)
+        except Exception as ex:
+            print(f"Error mirroring table {table_name}. Exception: {ex}")
+            return False
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO mirror_state VALUES (?, ?, ?, 1, ?)', (table_name, built_at, refresh_started, refreshed_at))
+        print(f"Mirrored {record_count} records of table {table_name}.")
+        return True
+
+    def mark_consistent(self):
+        with self.lock:
+            self.connection.execute('UPDATE mirror_state SET in_use = 0')
+
+    def get(self, table_name, key):
+        with self.lock:
+            row = self.connection.execute('SELECT preserved_fields FROM records WHERE table_name = ? AND record_key = ?', (table_name, self._encode_key(key))).fetchone()
+        if row is None:
+            return None
+
+        preserved_fields = {field_name: self.deserializer.deserialize(value) for field_name, value in json.loads(row[0]).items()}
+        return tuple(preserved_fields.get(field_name, MISSING_ATTRIBUTE) for field_name in PRESERVED_FIELDS[table_name])
+
+    def put(self, table_name, key, preserved_values):
+        self._put_rows([self._encode_row(table_name, key, preserved_values)])
+
+    def put_items(self, table_name, items):
+        self._put_rows([self._encode_row(table_name, get_item_key(table_name, item), get_preserved_values(table_name, item)) for item in items])
+
+    def _put_rows(self, rows):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+
+    def _encode_row(self, table_name, key, preserved_values):
+        # DynamoDb JSON keeps numbers as Decimal and None apart from a missing field
+        preserved_fields = {
+            field_name: self.serializer.serialize(value)
+            for field_name, value in zip(PRESERVED_FIELDS[table_name], preserved_values) if value is not MISSING_ATTRIBUTE
+            }
+        return table_name, self._encode_key(key), json.dumps(preserved_fields)
+
+    def _encode_key(self, key):
+        return json.dumps(list(key), default = str)
+
+
+class LocalMirrorIndex:
+    # Takes the place of a startup Scan index in existing_key_indexes for a table answered from the local mirror
+
+    def __init__(self, mirror, table_name):
+        self.mirror = mirror
+        self.table_name = table_name
+
+    def get(self, key, default = None):
+        preserved_values = self.mirror.get(self.table_name, key)
+        return default if preserved_values is None else preserved_values
+
+    def __setitem__(self, key, preserved_values):
+        self.mirror.put(self.table_name, key, preserved_values)
+
+
+def load_key_filter(table_name):
+    key_filter = None
+    try:
+        response = s3.get_object(Bucket = S3_BUCKET, Key = KEY_FILTER_KEY_PREFIX + table_name)
+        key_filter = KeyFilter.from_bytes(response['Body'].read())
+    except ClientError as ex:
+        if ex.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            print(f"Error loading key filter of table {table_name}. Exception: {ex}")
+
+    item_count = get_table_item_count(table_name)
+
+    if key_filter is not None:
+        # The item count DynamoDb reports is only updated every few hours, it can lag behind but not run ahead
+        if key_filter.key_count > key_filter.capacity:
+            print(f"Key filter of table {table_name} is full, building it again.")
+        elif item_count > key_filter.key_count * (1 + KEY_FILTER_DRIFT_TOLERANCE):
+            print(f"Table {table_name} has {item_count} records but its key filter only {key_filter.key_count} keys, building it again.")
+        else:
+            key_filters[table_name] = key_filter
+            return
+
+    print(f"Building key filter of table {table_name}.")
+    key_filter = KeyFilter(max(KEY_FILTER_MIN_CAPACITY, item_count * KEY_FILTER_CAPACITY_FACTOR))
+
+    def add_items(items):
+        for item in items:
+            key_filter.add(get_item_key(table_name, item))
+
+    try:
+        scan_existing_records(table_name, add_items)
+    except Exception as ex:
+        print(f"Error building key filter of table {table_name}. Exception: {ex}")
+        return
+
+    key_filters[table_name] = key_filter
+    print(f"Built key filter of table {table_name} with {key_filter.key_count} keys.")
+
+
+def get_table_item_count(table_name):
+    try:
+        return describe_table(table_name).get('ItemCount', 0)
+    except Exception as ex:
+        print(f"Error reading item count of table {table_name}. Exception: {ex}")
+        return 0
+
+
+def save_key_filters():
+    for table_name, key_filter in key_filters.items():
+        if key_filter.drifted:
+            # Built again from a Scan by the next import
+            s3.delete_object(Bucket = S3_BUCKET, Key = KEY_FILTER_KEY_PREFIX + table_name)
+        elif key_filter.changed:
+            s3.put_object(Bucket = S3_BUCKET, Key = KEY_FILTER_KEY_PREFIX + table_name, Body = key_filter.to_bytes())
+
+
+def is_definitely_absent(table_name, key):
+    key_filter = key_filters.get(table_name)
+    return key_filter is not None and not key_filter.drifted and not key_filter.might_contain(key)
+
+
+def put_item_not_in_key_filter(table, item):
+    # Written without a lookup because the key filter has never seen the key, the condition catches a record
+    # added outside of the import which the filter doesn't know about. Returns False if the record exists.
+    try:
+        call_dynamodb(table.name, 'write', 1, table.put_item, phase = 'insert', Item = item, ConditionExpression = Attr(TABLE_KEYS[table.name][0]).not_exists())
+        return True
+    except ClientError as ex:
+        if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+        # Unless the same record was just written by another worker, the filter is missing keys of the table
+        key = get_item_key(table.name, item)
+        if is_definitely_absent(table.name, key):
+            print(f"Key filter of table {table.name} is missing existing record {key}, it will be built again.")
+            key_filters[table.name].drifted = True
+        return False
+
+
+class KeyFilter:
+    # Bloom filter over the primary keys of one table. A key that was never added is reported as absent with
+    # certainty, any other key as possibly present. Stored as a JSON header line followed by the bit array.
+
+    def __init__(self, capacity, bit_count = None, hash_count = None, bits = None, key_count = 0):
+        self.capacity = capacity
+        self.bit_count = bit_count or max(8, math.ceil(-capacity * math.log(KEY_FILTER_FALSE_POSITIVE_RATE) / math.log(2) ** 2))
+        self.hash_count = hash_count or max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.bit_count + 7) // 8)
+        self.key_count = key_count
+        self.lock = threading.Lock()
+        self.changed = False
+        self.drifted = False
+
+    @classmethod
+    def from_bytes(cls, data):
+        header, bits = data.split(b'\n', 1)
+        header = json.loads(header)
+        return cls(header['capacity'], header['bitCount'], header['hashCount'], bytearray(bits), header['keyCount'])
+
+    def to_bytes(self):
+        header = {'capacity': self.capacity, 'bitCount': self.bit_count, 'hashCount': self.hash_count, 'keyCount': self.key_count}
+        return json.dumps(header).encode('utf-8') + b'\n' + bytes(self.bits)
+
+    def might_contain(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(key))
+
+    def add(self, key):
+        positions = self._get_positions(key)
+        with self.lock:
+            added = False
+            for position in positions:
+                if not self.bits[position >> 3] & (1 << (position & 7)):
+                    self.bits[position >> 3] |= 1 << (position & 7)
+                    added = True
+            # A key setting no new bit was added before, or is one of the false positives and isn't counted
+            if added:
+                self.key_count += 1
+                self.changed = True
+
+    def _get_positions(self, key):
+        # Double hashing, the positions are derived from two 64 bit halves of one hash
+        digest = hashlib.blake2b(json.dumps(list(key), default = str).encode('utf-8'), digest_size = 16).digest()
+        first_hash = int.from_bytes(digest[:8], 'little')
+        second_hash = int.from_bytes(digest[8:], 'little') | 1
+        return [(first_hash + index * second_hash) % self.bit_count for index in range(self.hash_count)]
+
+
+def get_item_key(table_name, item):
+    return tuple(item[key_name] for key_name in TABLE_KEYS[table_name])
+
+
+def get_preserved_values(table_name, item):
+    return tuple(item.get(field_name, MISSING_ATTRIBUTE) for field_name in PRESERVED_FIELDS[table_name])
+
+
+def add_to_key_index(table_name, item):
+    existing_key_indexes[table_name][get_item_key(table_name, item)] = get_preserved_values(table_name, item)
+
+
+def get_indexed_items(table_name, key_names, key_values):
+    # Answers a lookup from the startup index in the shape of a Query response, or returns None when the table
+    # has no index or the lookup isn't by the table's full primary key
+    if table_name not in existing_key_indexes or TABLE_KEYS[table_name] != key_names:
+        return None
+
+    preserved_values = existing_key_indexes[table_name].get(key_values)
+    if preserved_values is None:
+        return {'Items': []}
+
+    item = dict(zip(key_names, key_values))
+    for field_name, value in zip(PRESERVED_FIELDS[table_name], preserved_values):
+        if value is not MISSING_ATTRIBUTE:
+            item[field_name] = value
+    return {'Items': [item]}
+
+
+def get_dynamo_record_by_pk(pk_name, pk_value, table):
+    indexed_items = get_indexed_items(table.name, (pk_name,), (pk_value,))
+    if indexed_items is not None:
+        return indexed_items
+
+    try:
+        return lookup_cache.read_through(table.name, pk_value, (pk_name,),
+            lambda: call_dynamodb(table.name, 'read', 1, table.query, KeyConditionExpression=Key(pk_name).eq(pk_value)))
+    except Exception as ex:
+        print(f"Error retrieving records with primary key {pk_value} from table {table}. Exception: {ex}")
+
+
+def get_dynamo_record_by_pk_and_sk(pk_name, pk_value, sk_name, sk_value, table):
+    indexed_items = get_indexed_items(table.name, (pk_name, sk_name), (pk_value, sk_value))
+    if indexed_items is not None:
+        return indexed_items
+
+    try:
+        return lookup_cache.read_through(table.name, pk_value, (pk_name, 'key', sk_name, sk_value),
+            lambda: call_dynamodb(table.name, 'read', 1, table.query, KeyConditionExpression=Key(pk_name).eq(pk_value) & Key(sk_name).eq(sk_value)))
+    except Exception as ex:
+        print(f"Error retrieving records with primary key {pk_value} and sort key {sk_value} from table {table}. Exception: {ex}")
+
+
+def get_dynamo_record_by_pk_and_field_value(pk_name, pk_value, field_name, field_value, table):
+    indexed_items = get_indexed_items(table.name, (pk_name, field_name), (pk_value, field_value))
+    if indexed_items is not None:
+        return indexed_items
+
+    try:
+        return lookup_cache.read_through(table.name, pk_value, (pk_name, 'filter', field_name, field_value),
+            lambda: call_dynamodb(table.name, 'read', 1, table.query, KeyConditionExpression=Key(pk_name).eq(pk_value), FilterExpression=Attr(field_name).eq(field_value)))
+    except Exception as ex:
+        print(f"Error retrieving records with primary key {pk_value} and {field_name} {field_value} from table {table}. Exception: {ex}")
+
+
+class LookupCache:
+    # LRU cache of lookup responses keyed on (table name, partition key value, rest of the query), the partition key
+    # value comes first so every entry of a partition can be dropped when the importer writes to it
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.keys_by_partition = {}
+        # Partitions with lookups in flight, and those of them written to meanwhile whose responses may be stale
+        self.loading = {}
+        self.invalidated_while_loading = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def read_through(self, table_name, partition_key_value, query, load):
+        if not CACHE_LOOKUPS:
+            return load()
+
+        partition = (table_name, partition_key_value)
+        cache_key = (table_name, partition_key_value, query)
+
+        with self.lock:
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return self.entries[cache_key]
+            self.misses += 1
+            self.loading[partition] = self.loading.get(partition, 0) + 1
+
+        response = None
+        try:
+            response = load()
+        finally:
+            with self.lock:
+                stale = partition in self.invalidated_while_loading
+                self.loading[partition] -= 1
+                if not self.loading[partition]:
+                    del self.loading[partition]
+                    self.invalidated_while_loading.discard(partition)
+
+                if response is not None and not stale:
+                    self._store(partition, cache_key, response)
+
+        return response
+
+    def invalidate(self, table_name, item):
+        if not CACHE_LOOKUPS:
+            return
+
+        partition = (table_name, item[TABLE_KEYS[table_name][0]])
+        with self.lock:
+            for cache_key in self.keys_by_partition.pop(partition, ()):
+                del self.entries[cache_key]
+                self.invalidations += 1
+            if partition in self.loading:
+                self.invalidated_while_loading.add(partition)
+
+    def print_stats(self):
+        if self.hits or self.misses:
+            print(f"Lookup cache: {self.hits} hits, {self.misses} misses, {self.invalidations} invalidations, {self.evictions} evictions")
+
+    def _store(self, partition, cache_key, response):
+        self.entries[cache_key] = response
+        self.keys_by_partition.setdefault(partition, set()).add(cache_key)
+
+        if len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last = False)
+            evicted_partition = evicted_key[:2]
+            self.keys_by_partition[evicted_partition].discard(evicted_key)
+            if not self.keys_by_partition[evicted_partition]:
+                del self.keys_by_partition[evicted_partition]
+            self.evictions += 1
+
+
+class WarmKeyCache:
+    # Keys of records known to exist per table, kept at module level so it outlives the invocation. Only valid for
+    # the feed it was filled from, every key expires WARM_KEY_CACHE_TTL_SECONDS after DynamoDb last confirmed it.
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.etag = None
+        # (table name, key values) -> time the entry expires, least recently seen first
+        self.expiry_times = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def use_feed(self, etag):
+        with self.lock:
+            if etag != self.etag:
+                if self.expiry_times:
+                    print(f"Feed changed, forgetting {len(self.expiry_times)} keys known from the previous feed.")
+                self.expiry_times.clear()
+                self.etag = etag
+            self.hits = 0
+
+    def contains(self, table_name, key, count_hit = True):
+        with self.lock:
+            expiry_time = self.expiry_times.get((table_name, key))
+            if expiry_time is None:
+                return False
+            if expiry_time < time.monotonic():
+                del self.expiry_times[(table_name, key)]
+                return False
+            if count_hit:
+                self.hits += 1
+            return True
+
+    def add(self, table_name, key):
+        if not WARM_KEY_CACHE:
+            return
+
+        with self.lock:
+            self.expiry_times[(table_name, key)] = time.monotonic() + WARM_KEY_CACHE_TTL_SECONDS
+            self.expiry_times.move_to_end((table_name, key))
+            if len(self.expiry_times) > self.max_keys:
+                self.expiry_times.popitem(last = False)
+
+    def discard(self, table_name, key):
+        with self.lock:
+            self.expiry_times.pop((table_name, key), None)
+
+    def print_stats(self):
+        if self.hits:
+            print(f"Warm key cache: {self.hits} hits, {len(self.expiry_times)} keys remembered")
+
+
+def diff_feed(content, work_directory):
+    # Returns the sections of the feed with only added and changed records, and the path of the new feed's digest
+    # which is uploaded once the import succeeded
+    feed_path = os.path.join(work_directory, 'feed.json')
+    with open(feed_path, 'wb') as feed_file:
+        shutil.copyfileobj(content, feed_file, FEED_READ_CHUNK_SIZE)
+
+    feed_digest_path = write_feed_digest(feed_path, work_directory)
+
+    previous_digest_path = os.path.join(work_directory, 'previous-digest.tsv')
+    try:
+        s3.download_file(S3_BUCKET, FEED_DIGEST_KEY, previous_digest_path)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        print("No digest of a previously imported feed, importing every record.")
+        return iter_changed_sections(feed_path, None), feed_digest_path
+
+    changed_keys = diff_feed_digests(previous_digest_path, feed_digest_path)
+    return iter_changed_sections(feed_path, changed_keys), feed_digest_path
+
+
+def iter_feed_digest(feed_path):
+    # Yields a "key<TAB>hash" line for every movie, tv show and episode in the feed
+    with open(feed_path, 'rb') as feed_file:
+        for section_name, records in iter_feed_sections(feed_file):
+            if section_name == 'Movies':
+                for movie in records:
+                    yield f"{get_movie_diff_key(movie)}\t{get_record_digest(MOVIE_TABLE, lambda: build_movie_item(movie, None), movie)}\n"
+            elif section_name == 'TV Shows':
+                for tv_show in records:
+                    yield f"{get_tv_show_diff_key(tv_show)}\t{get_record_digest(TV_SHOW_TABLE, lambda: build_tv_show_item(tv_show, None), tv_show)}\n"
+                    for season in tv_show.get('seasons', []):
+                        for episode in season.get('episodes', []):
+                            episode_digest = get_record_digest(EPISODE_TABLE, lambda: build_episode_item(tv_show, season, episode, get_season_and_episode(season, episode), None), episode)
+                            yield f"{get_episode_diff_key(tv_show, season, episode)}\t{episode_digest}\n"
+
+
+def write_feed_digest(feed_path, work_directory):
+    # External sort: sorted runs of DIFF_SORT_RUN_SIZE lines are written to disk and merged into one sorted file
+    run_paths = []
+    digest_lines = iter_feed_digest(feed_path)
+
+    while True:
+        run = list(itertools.islice(digest_lines, DIFF_SORT_RUN_SIZE))
+        if not run:
+            break
+        run.sort()
+        run_paths.append(os.path.join(work_directory, f"digest-run-{len(run_paths)}.tsv"))
+        with open(run_paths[-1], 'w', encoding = 'utf-8') as run_file:
+            run_file.writelines(run)
+
+    feed_digest_path = os.path.join(work_directory, 'digest.tsv')
+    run_files = [open(run_path, encoding = 'utf-8') for run_path in run_paths]
+    try:
+        with open(feed_digest_path, 'w', encoding = 'utf-8') as feed_digest_file:
+            feed_digest_file.writelines(heapq.merge(*run_files))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+    for run_path in run_paths:
+        os.remove(run_path)
+    return feed_digest_path
+
+
+def diff_feed_digests(previous_digest_path, feed_digest_path):
+    # Walks both sorted digests side by side and returns the keys of records that are new or have a different hash.
+    # Records missing from the new feed are ignored, the import never deletes anything.
+    changed_keys = set()
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+
+    with open(previous_digest_path, encoding = 'utf-8') as previous_digest_file, open(feed_digest_path, encoding = 'utf-8') as feed_digest_file:
+        previous_entry = split_digest_line(next(previous_digest_file, None))
+
+        for line in feed_digest_file:
+            diff_key, digest = split_digest_line(line)
+
+            while previous_entry[0] is not None and previous_entry[0] < diff_key:
+                previous_entry = split_digest_line(next(previous_digest_file, None))
+
+            if previous_entry[0] != diff_key:
+                counts['added'] += 1
+                changed_keys.add(diff_key)
+            elif previous_entry[1] != digest:
+                counts['changed'] += 1
+                changed_keys.add(diff_key)
+            else:
+                counts['unchanged'] += 1
+
+    print(f"Feed diff: {counts['added']} added, {counts['changed']} changed, {counts['unchanged']} unchanged records.")
+    return changed_keys
+
+
+def split_digest_line(line):
+    if line is None:
+        return None, None
+    diff_key, digest = line.rstrip('\n').split('\t')
+    return diff_key, digest
+
+
+def iter_changed_sections(feed_path, changed_keys):
+    # Reads the spooled feed again and only passes on records whose key is in changed_keys (every record if it's None)
+    with open(feed_path, 'rb') as feed_file:
+        for section_name, records in iter_feed_sections(feed_file):
+            if changed_keys is None:
+                yield section_name, records
+            elif section_name == 'Movies':
+                yield section_name, (movie for movie in records if get_movie_diff_key(movie) in changed_keys)
+            elif section_name == 'TV Shows':
+                yield section_name, iter_changed_tv_shows(records, changed_keys)
+            else:
+                yield section_name, records
+
+
+def iter_changed_tv_shows(tv_shows, changed_keys):
+    for tv_show in tv_shows:
+        # Seasons are kept even when none of their episodes changed so numberOfSeasons stays right
+        for season in tv_show.get('seasons', []):
+            season['episodes'] = [episode for episode in season.get('episodes', []) if get_episode_diff_key(tv_show, season, episode) in changed_keys]
+
+        if get_tv_show_diff_key(tv_show) in changed_keys or any(season['episodes'] for season in tv_show.get('seasons', [])):
+            yield tv_show
+
+
+def get_movie_diff_key(movie):
+    return json.dumps(['Movies', movie.get('title'), movie.get('releaseDate')], default = str)
+
+
+def get_tv_show_diff_key(tv_show):
+    return json.dumps(['TV Shows', tv_show.get('title')], default = str)
+
+
+def get_episode_diff_key(tv_show, season, episode):
+    return json.dumps(['TV Shows', tv_show.get('title'), season.get('title'), episode.get('episodeNumber')], default = str)
+
+
+def get_record_digest(table_name, build_item, record):
+    # Same hash as the record fingerprints, a malformed record is hashed as it appears in the feed
+    try:
+        return get_fingerprint(table_name, build_item())
+    except Exception:
+        return hashlib.blake2b(json.dumps(record, sort_keys = True, default = str).encode('utf-8'), digest_size = 16).hexdigest()
+
+
+def iter_feed_sections(stream):
+    return JsonFeedStream(stream).iter_sections()
+
+
+class FeedSectionStream:
+    # Records of one section of a streamed feed, read from a GetObject of the feed's ETag opened when the iteration
+    # starts unless a stream is passed in. Sections before it are decoded and dropped, so every section can be imported
+    # on its own thread without the reader buffering the sections ahead of it.
+
+    def __init__(self, section_name, etag, stream = None):
+        self.section_name = section_name
+        self.etag = etag
+        self.stream = stream
+
+    def __iter__(self):
+        stream = self.stream
+        if stream is None:
+            with import_metrics.span('S3Download'):
+                stream = s3.get_object(Bucket = S3_BUCKET, Key = JSON_FILE, IfMatch = self.etag)['Body']
+
+        for section_name, records in iter_feed_sections(stream):
+            if section_name == self.section_name:
+                yield from records
+                return
+
+
+class JsonFeedStream:
+    # Incremental reader for a feed shaped like {"Movies": [...], "TV Shows": [...]}.
+    # Only the record currently being decoded is held in memory, never the whole feed.
+
+    def __init__(self, stream, chunk_size=FEED_READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        # Bytes of the stream dropped from the front of the buffer so far
+        self.consumed_bytes = 0
+
+    def iter_sections(self):
+        # Yields (section name, record iterator) for every top level array. The iterator must be
+        # consumed before advancing to the next section; anything left unread is skipped.
+        self._expect('{')
+
+        if self._peek() == '}':
+            self.position += 1
+            return
+
+        while True:
+            section_name = self._decode_value()
+            self._expect(':')
+
+            if self._peek() == '[':
+                records = self._iter_array()
+                yield section_name, records
+                for _ in records:
+                    pass
+            else:
+                self._decode_value()
+
+            separator = self._peek()
+            self.position += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"Malformed feed: expected ',' or '}}' after section {section_name}, found {separator!r}")
+
+    def iter_records(self):
+        # Yields the records of a byte range cut out of a section, which starts before a record at the section's '['
+        # or a ',' and ends after a record or at the section's ']'
+        while True:
+            separator = self._peek()
+            if separator in ('', ']'):
+                return
+            if separator in ('[', ','):
+                self.position += 1
+                continue
+            yield self._decode_value()
+
+    def get_byte_offset(self):
+        # Offset in the stream of the next character to be read, the feed is UTF-8 so it encodes back to the same bytes
+        return self.consumed_bytes + len(self.buffer[:self.position].encode('utf-8'))
+
+    def _iter_array(self):
+        self._expect('[')
+
+        if self._peek() == ']':
+            self.position += 1
+            return
+
+        while True:
+            yield self._decode_value()
+
+            separator = self._peek()
+            self.position += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Malformed feed: expected ',' or ']' between records, found {separator!r}")
+
+    def _decode_value(self):
+        self._peek()
+
+        while True:
+            started = time.perf_counter()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                import_metrics.add_time('JsonParse', None, time.perf_counter() - started)
+                if self.eof:
+                    raise
+                # Record is split across chunks, read at least as much again as is already buffered
+                self._fill(len(self.buffer) - self.position)
+                continue
+            import_metrics.add_time('JsonParse', None, time.perf_counter() - started)
+
+            # A number or literal ending exactly at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+
+            self.position = end
+            return value
+
+    def _peek(self):
+        # Skip whitespace and return the next character without consuming it ('' at end of stream)
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return ''
+
+            self._fill()
+
+    def _expect(self, character):
+        found = self._peek()
+        if found != character:
+            raise ValueError(f"Malformed feed: expected {character!r}, found {found!r}")
+        self.position += 1
+
+    def _fill(self, minimum_size=0):
+        with import_metrics.span('S3Download'):
+            chunk = self.stream.read(max(self.chunk_size, minimum_size))
+
+        # Drop everything already consumed so the buffer only ever holds the record in progress
+        self.consumed_bytes += len(self.buffer[:self.position].encode('utf-8'))
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk or b'', final = not chunk)
+        self.position = 0
+
+        if not chunk:
+            self.eof = True